@@ -1,17 +1,16 @@
 # Enhanced Face Recognition Server - Motion Detection System
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import cv2
 import face_recognition
+import dlib
 import numpy as np
-import io
 import base64
-from PIL import Image
 import json
+import orjson
 from typing import Optional, Dict, Any, List
-import requests
 from datetime import datetime, timedelta
 import logging
 from dotenv import load_dotenv
@@ -19,10 +18,12 @@ import os
 from supabase import create_client, Client
 import asyncio
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import threading
 import time
-import heapq
+import hashlib
+from collections import Counter, OrderedDict
 
 # Load environment variables
 load_dotenv()
@@ -32,12 +33,78 @@ HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", 8000))
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 FACE_THRESHOLD = float(os.getenv("FACE_VERIFICATION_THRESHOLD", 0.7))
+# "blend" = 0.4 Euclidean + 0.6 cosine; "cosine" scores by cosine alone (phase thresholds need re-tuning for it)
+SIMILARITY_METRIC = os.getenv("SIMILARITY_METRIC", "blend").lower()
 
 # Motion Detection Configuration
 MOTION_DETECTION_ENABLED = os.getenv("MOTION_DETECTION_ENABLED", "true").lower() == "true"
 DEFAULT_MOTION_THRESHOLD = float(os.getenv("DEFAULT_MOTION_THRESHOLD", 0.1))
 MOTION_COOLDOWN_SECONDS = int(os.getenv("MOTION_COOLDOWN_SECONDS", 30))
 MAX_SNAPSHOTS_PER_HOUR = int(os.getenv("MAX_SNAPSHOTS_PER_HOUR", 120))
+MAX_MOTION_SESSIONS = int(os.getenv("MAX_MOTION_SESSIONS", 500))
+MOTION_SESSION_MAX_AGE_HOURS = int(os.getenv("MOTION_SESSION_MAX_AGE_HOURS", 12))
+
+# Face Cache Configuration
+FACE_CACHE_TTL_SECONDS = int(os.getenv("FACE_CACHE_TTL_SECONDS", 300))
+# Least recently used embeddings are evicted beyond this many students
+FACE_CACHE_MAX_SIZE = int(os.getenv("FACE_CACHE_MAX_SIZE", 10000))
+# Class roster (student ids + emails) cache
+CLASS_ROSTER_TTL_SECONDS = int(os.getenv("CLASS_ROSTER_TTL_SECONDS", 300))
+
+# Warm-start snapshot of face_cache (<path>.npy + <path>.json), empty disables it
+FACE_CACHE_PATH = os.getenv("FACE_CACHE_PATH", "")
+FACE_CACHE_PERSIST_SECONDS = int(os.getenv("FACE_CACHE_PERSIST_SECONDS", 300))
+
+# Raw float32 embedding column (base64 text), requires:
+#   ALTER TABLE student_face_embeddings ADD COLUMN face_embedding_bytes TEXT;
+# The JSON column is still written for the Flutter app and legacy rows
+FACE_EMBEDDING_BYTES_ENABLED = os.getenv("FACE_EMBEDDING_BYTES_ENABLED", "false").lower() == "true"
+EMBEDDING_SELECT_COLUMNS = 'face_embedding_json, face_embedding_bytes' if FACE_EMBEDDING_BYTES_ENABLED else 'face_embedding_json'
+
+# Faces scoring below this quality are dropped before the (expensive) encoding pass, 0 disables the gate
+MIN_FACE_QUALITY = float(os.getenv("MIN_FACE_QUALITY", 0.0))
+
+# Face Detection Configuration
+# dlib's CNN detector and ResNet encoder run on the GPU when dlib is built with CUDA (-DDLIB_USE_CUDA=1)
+USE_GPU = os.getenv("USE_GPU", "1") == "1"
+DLIB_CUDA_AVAILABLE = USE_GPU and bool(getattr(dlib, "DLIB_USE_CUDA", False))
+HOG_DETECTION_MAX_EDGE = int(os.getenv("HOG_DETECTION_MAX_EDGE", 960))
+# The CNN detector is kept at a higher resolution so small classroom faces are still found
+CNN_DETECTION_MAX_EDGE = int(os.getenv("CNN_DETECTION_MAX_EDGE", 1600))
+# Lower-accuracy phases detect on a further downscaled frame (never above the max edge caps)
+DETECTION_SCALE_BY_ACCURACY = {'high': 1.0, 'medium': 0.66, 'standard': 0.4}
+# Capture encodings are compared against enrollment embeddings already averaged over jittered passes,
+# so captures default to a single ResNet pass (dlib treats 0 and 1 alike); raise for extra robustness
+CAPTURE_NUM_JITTERS = int(os.getenv("CAPTURE_NUM_JITTERS", 1))
+# Jittered ResNet passes per enrollment image (each pass costs a full forward pass)
+ENROLL_NUM_JITTERS = int(os.getenv("ENROLL_NUM_JITTERS", 3))
+# Optional OpenCV YuNet detector (e.g. face_detection_yunet_2023mar_int8.onnx) used in place of dlib HOG
+YUNET_MODEL_PATH = os.getenv("YUNET_MODEL_PATH", "")
+YUNET_SCORE_THRESHOLD = float(os.getenv("YUNET_SCORE_THRESHOLD", 0.6))
+YUNET_ENABLED = bool(YUNET_MODEL_PATH) and os.path.exists(YUNET_MODEL_PATH)
+# Frames are already processed concurrently on the thread pool, so per-call OpenCV threading only adds contention
+OPENCV_NUM_THREADS = int(os.getenv("OPENCV_NUM_THREADS", 1))
+
+# Motion Queue Batching Configuration
+MOTION_BATCH_SIZE = int(os.getenv("MOTION_BATCH_SIZE", 8))
+MOTION_BATCH_WINDOW_MS = int(os.getenv("MOTION_BATCH_WINDOW_MS", 15))
+MAX_MOTION_QUEUE_SIZE = int(os.getenv("MAX_MOTION_QUEUE_SIZE", 256))
+# Thread pool for decode/detect/encode jobs, sized to the machine so small instances are not oversubscribed
+FACE_WORKER_THREADS = int(os.getenv("FACE_WORKER_THREADS", min(8, os.cpu_count() or 1)))
+# dlib holds the GIL while detecting/encoding, so >0 moves that work into worker processes.
+# Trade-off: workers have their own caches, so the quick count no longer seeds detection_cache,
+# batched GPU prefetch, FRAME_REUSE_GRID and face_crop_cache are disabled, and detection_cache only hits per worker
+MOTION_PROCESS_WORKERS = int(os.getenv("MOTION_PROCESS_WORKERS", 0))
+# Detections/encodings memoized by image content hash so retried uploads skip the detector and ResNet
+DETECTION_CACHE_SIZE = int(os.getenv("DETECTION_CACHE_SIZE", 64))
+# Encodings memoized per session by a dHash of the face crop plus its coarse position, so stationary
+# students are not re-encoded on every capture; 0 disables it (near-identical crops share one encoding)
+FACE_CROP_CACHE_SIZE = int(os.getenv("FACE_CROP_CACHE_SIZE", 0))
+# Consecutive captures from a fixed classroom camera are split into an N x N grid of dHashed tiles;
+# unchanged tiles inherit the previous capture's faces and only the changed region is re-detected, 0 disables it
+FRAME_REUSE_GRID = int(os.getenv("FRAME_REUSE_GRID", 0))
+FRAME_REUSE_MAX_TILE_BITS = int(os.getenv("FRAME_REUSE_MAX_TILE_BITS", 4))  # of 64 dHash bits per tile
+FRAME_REUSE_MAX_AGE_SECONDS = int(os.getenv("FRAME_REUSE_MAX_AGE_SECONDS", 600))  # force a full detection after this
 
 # Supabase setup
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -56,7 +123,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Motion Detection Attendance System",
     description="Face Recognition Server with Motion-Triggered Snapshots",
-    version="5.0.0"
+    version="5.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -69,12 +137,28 @@ app.add_middleware(
 )
 
 # Thread pool for processing
-executor = ThreadPoolExecutor(max_workers=8)
+executor = ThreadPoolExecutor(max_workers=FACE_WORKER_THREADS)
+process_executor = None  # Optional ProcessPoolExecutor for detection/encoding, created at startup
+
+# Long-running background tasks (kept referenced so they are not garbage collected)
+server_tasks = set()
 
 # In-memory cache and tracking
-face_cache = {}
+face_cache = OrderedDict()  # student_id -> (embedding, cached_at), LRU ordered
+face_cache_stats = Counter()  # 'hits' / 'misses', updated under cache_lock
+face_cache_version = 0  # Bumped under cache_lock on every insert, so the snapshot task sees refreshed embeddings
+class_roster_cache = {}  # class_id -> (student_ids, cached_at)
+student_email_cache = {}  # school_id -> (email, cached_at)
+roster_matrix_cache = OrderedDict()  # tuple(student_ids) -> (matrix, ids, squared_norms, built_at), LRU ordered
 motion_sessions = {}  # Track motion detection sessions
 cache_lock = threading.Lock()
+detection_cache = OrderedDict()  # (image digest, model, scale) -> {'locations', 'encodings': {(location, jitters): encoding}}
+detection_cache_lock = threading.Lock()
+face_crop_cache = OrderedDict()  # (session_id, dhash, coarse box, jitters) -> encoding
+session_frame_cache = OrderedDict()  # session_id -> {'shape', 'model', 'scale', 'tile_bits', 'locations', 'detected_at'}
+session_frame_lock = threading.Lock()
+session_write_locks = {}  # session_id -> asyncio.Lock serializing attendance writes per session
+yunet_local = threading.local()  # FaceDetectorYN is stateful, so one instance per worker thread
 
 # ==================== Pydantic Models ====================
 
@@ -193,13 +277,20 @@ motion_processor = MotionDetectionProcessor()
 # ==================== Motion Session Management ====================
 
 class MotionSessionManager:
-    def __init__(self):
+    def __init__(self, max_sessions: int = MAX_MOTION_SESSIONS):
         self.sessions = {}
+        self.max_sessions = max_sessions
         self.lock = threading.Lock()
     
     def create_session(self, session_id: str, config: Dict):
         """Create motion detection session"""
         with self.lock:
+            # Evict the oldest tracked session when at capacity
+            if session_id not in self.sessions and len(self.sessions) >= self.max_sessions:
+                oldest_id = min(self.sessions, key=lambda sid: self.sessions[sid]['created_at'])
+                del self.sessions[oldest_id]
+                logger.warning(f"📱 Motion session limit reached, evicted: {oldest_id}")
+            
             self.sessions[session_id] = {
                 'session_id': session_id,
                 'created_at': datetime.now(),
@@ -298,6 +389,18 @@ class MotionSessionManager:
             if session_id in self.sessions:
                 del self.sessions[session_id]
                 logger.info(f"📱 Motion session removed: {session_id}")
+    
+    def remove_stale_sessions(self, max_age: timedelta) -> int:
+        """Remove sessions that were never ended explicitly"""
+        cutoff = datetime.now() - max_age
+        with self.lock:
+            stale_ids = [sid for sid, session in self.sessions.items() if session['created_at'] < cutoff]
+            for sid in stale_ids:
+                del self.sessions[sid]
+        
+        if stale_ids:
+            logger.info(f"🧹 Removed {len(stale_ids)} stale motion sessions")
+        return len(stale_ids)
 
 # Global session manager
 motion_session_manager = MotionSessionManager()
@@ -305,65 +408,501 @@ motion_session_manager = MotionSessionManager()
 # ==================== Priority Queue for Motion Processing ====================
 
 class MotionPriorityQueue:
-    def __init__(self):
-        self.queue = []
+    def __init__(self, maxsize: int = MAX_MOTION_QUEUE_SIZE):
+        self.queue = asyncio.PriorityQueue(maxsize=maxsize)
         self.index = 0
-        self.lock = asyncio.Lock()
-    
-    async def put(self, item):
-        async with self.lock:
-            priority = item['priority']
-            # Motion-triggered items get slight priority boost
-            if item.get('trigger_type') == 'motion':
-                priority = max(1, priority - 0.5)
-            
-            heapq.heappush(self.queue, (priority, self.index, item))
-            self.index += 1
+    
+    async def put(self, item) -> bool:
+        """Queue an item; returns False when the queue is full (backpressure)"""
+        priority = item['priority']
+        # Motion-triggered items get slight priority boost
+        if item.get('trigger_type') == 'motion':
+            priority = max(1, priority - 0.5)
+        
+        try:
+            self.queue.put_nowait((priority, self.index, item))
+        except asyncio.QueueFull:
+            return False
+        
+        self.index += 1
+        return True
     
     async def get(self):
-        async with self.lock:
-            if self.queue:
-                priority, index, item = heapq.heappop(self.queue)
-                return item
-            return None
+        """Wait for the highest-priority item"""
+        priority, index, item = await self.queue.get()
+        return item
     
     def qsize(self):
-        return len(self.queue)
+        return self.queue.qsize()
 
 # Global queue
 motion_processing_queue = MotionPriorityQueue()
 
 # ==================== Enhanced Helper Functions ====================
 
-def get_face_embedding_cached(student_id: str) -> Optional[np.ndarray]:
-    """Get face embedding with caching for motion-triggered processing"""
+async def run_supabase(query):
+    """Execute a Supabase query builder off the event loop (the client is blocking)"""
+    return await asyncio.to_thread(query.execute)
+
+def decode_image_rgb(image_data: bytes) -> np.ndarray:
+    """Decode image bytes into an RGB array for face encoding"""
+    bgr = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError("Could not decode image")
+    # Convert in place so a decode holds one full-size frame, not two
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=bgr)
+
+def decode_image_gray(image_data: bytes, reduced: bool = False) -> np.ndarray:
+    """Decode image bytes straight to grayscale (detection needs no color)"""
+    # Reduced mode uses libjpeg's 2:1 IDCT scaling, so half-resolution comes for free
+    flags = cv2.IMREAD_REDUCED_GRAYSCALE_2 if reduced else cv2.IMREAD_GRAYSCALE
+    gray = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), flags)
+    if gray is None:
+        raise ValueError("Could not decode image data")
+    return gray
+
+def count_faces(image_data: bytes, background_model: Optional[str] = None, background_scale: float = 1.0, session_id: Optional[str] = None) -> int:
+    """Quick HOG face count used for immediate endpoint responses"""
+    # When the background pass will run HOG anyway, detect once exactly as it would
+    # and leave the result in detection_cache for it to reuse (worker processes cannot see it)
+    if background_model == "hog" and DETECTION_CACHE_SIZE > 0 and process_executor is None:
+        image_array = decode_image_rgb(image_data)
+        # The background pass will hit detection_cache, so frame reuse has to happen here
+        if FRAME_REUSE_GRID > 0 and session_id is not None:
+            locations = detect_faces_with_frame_reuse(image_array, session_id, "hog", background_scale)
+        else:
+            locations = detect_faces(image_array, model="hog", scale=background_scale)
+        store_cached_detection((image_digest(image_data), "hog", background_scale), {'locations': locations, 'encodings': {}})
+        return len(locations)
+    
+    return len(detect_faces(decode_image_gray(image_data, reduced=True), model="hog"))
+
+def scale_face_location(location: tuple, factor: float, height: int, width: int) -> tuple:
+    """Scale a (top, right, bottom, left) box and clamp it to the image bounds"""
+    top, right, bottom, left = location
+    return (
+        max(0, int(top * factor)),
+        min(width, int(right * factor)),
+        min(height, int(bottom * factor)),
+        max(0, int(left * factor))
+    )
+
+def detect_faces_yunet(image_array: np.ndarray) -> List[tuple]:
+    """Detect faces with OpenCV YuNet, returning (top, right, bottom, left) boxes"""
+    detector = getattr(yunet_local, 'detector', None)
+    if detector is None:
+        detector = cv2.FaceDetectorYN.create(YUNET_MODEL_PATH, "", (320, 320), score_threshold=YUNET_SCORE_THRESHOLD)
+        yunet_local.detector = detector
+    
+    if image_array.ndim == 2:
+        bgr = cv2.cvtColor(image_array, cv2.COLOR_GRAY2BGR)
+    else:
+        bgr = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+    
+    height, width = bgr.shape[:2]
+    detector.setInputSize((width, height))
+    _, faces = detector.detect(bgr)
+    if faces is None:
+        return []
+    
+    locations = []
+    for face in faces:
+        x, y, w, h = face[:4].astype(np.float32)
+        locations.append((
+            max(0, int(y)),
+            min(width, int(x + w)),
+            min(height, int(y + h)),
+            max(0, int(x))
+        ))
+    return locations
+
+def resize_for_detection(image_array: np.ndarray, model: str, scale: float) -> tuple:
+    """Downscale a frame to the detector's max edge, returns (image, factor)"""
+    longest_edge = max(image_array.shape[:2])
+    max_edge = CNN_DETECTION_MAX_EDGE if model == "cnn" else HOG_DETECTION_MAX_EDGE
+    max_edge = min(max_edge, int(longest_edge * scale))
+    
+    # Detection cost scales with pixel count, so detect on a downscaled copy
+    # and map the boxes back so encodings still use the full-resolution frame
+    if longest_edge <= max_edge:
+        return image_array, 1.0
+    factor = max_edge / longest_edge
+    return cv2.resize(image_array, (0, 0), fx=factor, fy=factor, interpolation=cv2.INTER_AREA), factor
+
+def detect_faces(image_array: np.ndarray, model: str = "hog", scale: float = 1.0) -> List[tuple]:
+    """Detect face locations, preferring the GPU CNN detector when CUDA is available"""
+    if DLIB_CUDA_AVAILABLE:
+        model = "cnn"
+    
+    height, width = image_array.shape[:2]
+    small, factor = resize_for_detection(image_array, model, scale)
+    
+    if model == "hog" and YUNET_ENABLED:
+        locations = detect_faces_yunet(small)
+    elif model == "hog":
+        # HOG only needs gradients, so scan one channel instead of three
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY) if small.ndim == 3 else small
+        locations = face_recognition.face_locations(gray, model=model)
+    else:
+        locations = face_recognition.face_locations(small, model=model)
+    
+    if factor == 1.0:
+        return locations
+    return [scale_face_location(loc, 1.0 / factor, height, width) for loc in locations]
+
+def detect_faces_batch(images: List[np.ndarray], scales: List[float]) -> List[List[tuple]]:
+    """Detect faces in several frames with batched GPU CNN passes, one per distinct frame size"""
+    results = [[] for _ in images]
+    groups = {}
+    for i, (image_array, scale) in enumerate(zip(images, scales)):
+        small, factor = resize_for_detection(image_array, "cnn", scale)
+        groups.setdefault(small.shape, []).append((i, small, factor))
+    
+    # dlib's batched CNN detector needs equally sized frames
+    for members in groups.values():
+        batch_locations = face_recognition.batch_face_locations(
+            [small for _, small, _ in members],
+            batch_size=len(members)
+        )
+        for (i, _, factor), locations in zip(members, batch_locations):
+            height, width = images[i].shape[:2]
+            results[i] = [scale_face_location(loc, 1.0 / factor, height, width) for loc in locations] if factor != 1.0 else list(locations)
+    
+    return results
+
+def compute_face_encodings(image_array: np.ndarray, face_locations: List[tuple], num_jitters: int = 1) -> List[np.ndarray]:
+    """Encode all faces in one batched dlib forward pass instead of one call per face"""
+    if not face_locations:
+        return []
+    
+    try:
+        landmarks = face_recognition.api._raw_face_landmarks(image_array, face_locations, model="small")
+        shapes = dlib.full_object_detections()
+        for landmark in landmarks:
+            shapes.append(landmark)
+        descriptors = face_recognition.api.face_encoder.compute_face_descriptor(image_array, shapes, num_jitters)
+        return [np.array(descriptor) for descriptor in descriptors]
+    except (AttributeError, TypeError) as e:
+        # Older dlib builds lack the batched overload
+        logger.debug(f"Batched face encoding unavailable, falling back: {e}")
+        return face_recognition.face_encodings(image_array, face_locations, num_jitters=num_jitters)
+
+def frame_tile_bits(image_array: np.ndarray) -> np.ndarray:
+    """Per-tile 64-bit dHash of a frame on a FRAME_REUSE_GRID x FRAME_REUSE_GRID grid"""
+    gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY) if image_array.ndim == 3 else image_array
+    small = cv2.resize(gray, (FRAME_REUSE_GRID * 9, FRAME_REUSE_GRID * 8), interpolation=cv2.INTER_AREA)
+    tiles = small.reshape(FRAME_REUSE_GRID, 8, FRAME_REUSE_GRID, 9)
+    return tiles[:, :, :, 1:] > tiles[:, :, :, :-1]  # (grid, 8, grid, 8)
+
+def detect_faces_with_frame_reuse(image_array: np.ndarray, session_id: str, model: str, scale: float) -> List[tuple]:
+    """Detect faces, re-running the detector only where the frame changed since the session's last capture"""
+    height, width = image_array.shape[:2]
+    tile_bits = frame_tile_bits(image_array)
+    now = time.time()
+    
+    with session_frame_lock:
+        previous = session_frame_cache.get(session_id)
+    
+    changed = None
+    if (previous is not None and previous['shape'] == image_array.shape and previous['model'] == model
+            and previous['scale'] == scale and now - previous['detected_at'] < FRAME_REUSE_MAX_AGE_SECONDS):
+        changed = (tile_bits != previous['tile_bits']).sum(axis=(1, 3)) > FRAME_REUSE_MAX_TILE_BITS
+    
+    # Tiles are compared against the frame their faces were last detected on, so slow drift still adds up
+    reference_bits = tile_bits
+    if changed is not None and not changed.any():
+        locations = list(previous['locations'])
+        detected_at = previous['detected_at']
+        reference_bits = previous['tile_bits']
+        logger.info("♻️ Frame unchanged since last capture, reusing face locations")
+    elif changed is not None and changed.mean() <= 0.5:
+        # Crop the changed tiles plus a one-tile margin, grown to cover any earlier face it touches
+        rows, cols = np.nonzero(changed)
+        tile_h, tile_w = height / FRAME_REUSE_GRID, width / FRAME_REUSE_GRID
+        top = int(max(0, (rows.min() - 1) * tile_h))
+        bottom = int(min(height, (rows.max() + 2) * tile_h))
+        left = int(max(0, (cols.min() - 1) * tile_w))
+        right = int(min(width, (cols.max() + 2) * tile_w))
+        
+        def overlaps_crop(loc):
+            return loc[0] < bottom and loc[2] > top and loc[3] < right and loc[1] > left
+        
+        # Grow until stable, since covering one face can pull the crop over another
+        grown = True
+        while grown:
+            grown = False
+            for loc in previous['locations']:
+                if overlaps_crop(loc) and (loc[0] < top or loc[2] > bottom or loc[3] < left or loc[1] > right):
+                    top, bottom = min(top, loc[0]), max(bottom, loc[2])
+                    left, right = min(left, loc[3]), max(right, loc[1])
+                    grown = True
+        
+        # Faces inside the final crop are re-detected there, the rest are kept as they were
+        kept = [loc for loc in previous['locations'] if not overlaps_crop(loc)]
+        
+        redetected = detect_faces(np.ascontiguousarray(image_array[top:bottom, left:right]), model=model, scale=scale)
+        locations = kept + [(t + top, r + left, b + top, l + left) for t, r, b, l in redetected]
+        detected_at = previous['detected_at']
+        
+        # Only tiles lying wholly inside the crop were re-detected
+        row_edges = (np.arange(FRAME_REUSE_GRID + 1) * tile_h).astype(int)
+        col_edges = (np.arange(FRAME_REUSE_GRID + 1) * tile_w).astype(int)
+        tile_rows = (row_edges[:-1] >= top) & (row_edges[1:] <= bottom)
+        tile_cols = (col_edges[:-1] >= left) & (col_edges[1:] <= right)
+        redetected_tiles = tile_rows[:, None] & tile_cols[None, :]
+        reference_bits = np.where(redetected_tiles[:, None, :, None], tile_bits, previous['tile_bits'])
+        logger.info(f"♻️ Re-detected {int(changed.sum())}/{changed.size} changed tiles")
+    else:
+        locations = detect_faces(image_array, model=model, scale=scale)
+        detected_at = now
+    
+    with session_frame_lock:
+        session_frame_cache[session_id] = {
+            'shape': image_array.shape,
+            'model': model,
+            'scale': scale,
+            'tile_bits': reference_bits,
+            'locations': locations,
+            'detected_at': detected_at
+        }
+        session_frame_cache.move_to_end(session_id)
+        while len(session_frame_cache) > MAX_MOTION_SESSIONS:
+            session_frame_cache.popitem(last=False)
+    
+    return locations
+
+def image_digest(image_data: bytes) -> bytes:
+    """Content hash used to recognise repeated uploads of the same image"""
+    return hashlib.blake2b(image_data, digest_size=16).digest()
+
+def get_cached_detection(key: tuple) -> Optional[Dict]:
+    """Look up a memoized detection result, refreshing its LRU position"""
+    with detection_cache_lock:
+        entry = detection_cache.get(key)
+        if entry is not None:
+            detection_cache.move_to_end(key)
+        return entry
+
+def store_cached_detection(key: tuple, entry: Dict):
+    """Memoize a detection result, evicting the least recently used entry"""
+    with detection_cache_lock:
+        detection_cache[key] = entry
+        detection_cache.move_to_end(key)
+        while len(detection_cache) > DETECTION_CACHE_SIZE:
+            detection_cache.popitem(last=False)
+
+def face_crop_key(image_array: np.ndarray, location: tuple, num_jitters: int) -> tuple:
+    """dHash of a face crop plus its position on a 16px grid, used as a face_crop_cache key"""
+    top, right, bottom, left = location
+    crop = image_array[top:bottom, left:right]
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(crop, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
+    return bits, top // 16, right // 16, bottom // 16, left // 16, num_jitters
+
+def encode_faces_with_crop_cache(image_array: np.ndarray, face_locations: List[tuple], num_jitters: int, session_id: Optional[str] = None) -> List[np.ndarray]:
+    """compute_face_encodings, reusing a session's encodings of near-identical crops when FACE_CROP_CACHE_SIZE > 0"""
+    # Scoped to the session, so a different student later sitting in the same seat never inherits an encoding
+    if FACE_CROP_CACHE_SIZE <= 0 or session_id is None:
+        return compute_face_encodings(image_array, face_locations, num_jitters=num_jitters)
+    
+    keys = [(session_id,) + face_crop_key(image_array, location, num_jitters) for location in face_locations]
+    encodings = [None] * len(face_locations)
+    with detection_cache_lock:
+        for i, key in enumerate(keys):
+            encoding = face_crop_cache.get(key)
+            if encoding is not None:
+                face_crop_cache.move_to_end(key)
+                encodings[i] = encoding
+    
+    missing = [i for i, encoding in enumerate(encodings) if encoding is None]
+    if missing:
+        new_encodings = compute_face_encodings(image_array, [face_locations[i] for i in missing], num_jitters=num_jitters)
+        with detection_cache_lock:
+            for i, encoding in zip(missing, new_encodings):
+                encodings[i] = encoding
+                face_crop_cache[keys[i]] = encoding
+            while len(face_crop_cache) > FACE_CROP_CACHE_SIZE:
+                face_crop_cache.popitem(last=False)
+    
+    return encodings
+
+def encode_embedding_bytes(encoding: np.ndarray) -> str:
+    """Serialize an embedding as base64 of its raw float32 bytes"""
+    return base64.b64encode(encoding.astype(np.float32).tobytes()).decode('ascii')
+
+def decode_embedding_row(row: Dict) -> np.ndarray:
+    """Load an embedding row, preferring raw float32 bytes over the JSON column"""
+    if row.get('face_embedding_bytes'):
+        return np.frombuffer(base64.b64decode(row['face_embedding_bytes']), dtype=np.float32)
+    return np.array(orjson.loads(row['face_embedding_json']), dtype=np.float32)
+
+def cache_face_embedding(student_id: str, embedding: np.ndarray, cached_at: float):
+    """Insert into face_cache, evicting least recently used entries (caller holds cache_lock)"""
+    global face_cache_version
+    face_cache_version += 1
+    face_cache[student_id] = (embedding, cached_at)
+    face_cache.move_to_end(student_id)
+    while len(face_cache) > FACE_CACHE_MAX_SIZE:
+        face_cache.popitem(last=False)
+
+def warm_face_cache(student_ids: List[str]) -> tuple:
+    """Load embeddings for many students in one query, returns (embeddings, fetch_succeeded)"""
+    embeddings = {}
+    missing = []
+    now = time.monotonic()
     with cache_lock:
-        if student_id in face_cache:
-            return face_cache[student_id]
+        for student_id in student_ids:
+            cached = face_cache.get(student_id)
+            if cached is not None and now - cached[1] < FACE_CACHE_TTL_SECONDS:
+                face_cache.move_to_end(student_id)
+                embeddings[student_id] = cached[0]
+            else:
+                missing.append(student_id)
+        face_cache_stats['hits'] += len(embeddings)
+        face_cache_stats['misses'] += len(missing)
+    
+    if not missing:
+        return embeddings, True
     
     try:
-        result = supabase.table('student_face_embeddings').select('face_embedding_json').eq('student_id', student_id).eq('is_active', True).single().execute()
+        result = supabase.table('student_face_embeddings').select(f'student_id, {EMBEDDING_SELECT_COLUMNS}').in_('student_id', missing).eq('is_active', True).execute()
         
-        if result.data:
-            embedding_json = json.loads(result.data['face_embedding_json'])
-            embedding = np.array(embedding_json, dtype=np.float64)
-            
-            # Cache the embedding
-            with cache_lock:
-                face_cache[student_id] = embedding
-            
-            return embedding
+        fetched = {}
+        for row in result.data or []:
+            try:
+                fetched[row['student_id']] = decode_embedding_row(row)
+            except Exception as e:
+                logger.error(f"Error decoding face embedding for {row.get('student_id')}: {e}")
+        
+        cached_at = time.monotonic()
+        with cache_lock:
+            for student_id, embedding in fetched.items():
+                cache_face_embedding(student_id, embedding, cached_at)
+        
+        embeddings.update(fetched)
     except Exception as e:
-        logger.error(f"Error getting face embedding for {student_id}: {e}")
+        logger.error(f"Error warming face cache for {len(missing)} students: {e}")
+        return embeddings, False
+    
+    return embeddings, True
 
-    return None
+def select_detection_model(config: Dict, motion_strength: float) -> tuple:
+    """Choose (detector model, num_jitters) based on motion strength and config"""
+    if motion_strength > 0.3 and config.get('motion_boost', False):
+        return "cnn", CAPTURE_NUM_JITTERS  # Use high-accuracy model for strong motion
+    if config['model_accuracy'] == 'high':
+        return "cnn", CAPTURE_NUM_JITTERS
+    return "hog", 1
 
-def process_motion_triggered_faces(image_array: np.ndarray, enrolled_students: List[str], config: Dict, motion_strength: float) -> List[Dict]:
+def select_detection_scale(config: Dict) -> float:
+    """Extra detection downscale for the phase's model accuracy"""
+    return DETECTION_SCALE_BY_ACCURACY.get(config.get('model_accuracy'), 1.0)
+
+def motion_pipeline_config(item: Dict) -> Dict:
+    """Processing config a queued motion item is run with"""
+    if item['processing_type'] == 'session_start':
+        return motion_processor.get_config('0-10')  # Use highest accuracy
+    if item['processing_type'] == 'manual_teacher_capture':
+        # Use high accuracy for manual teacher captures
+        manual_config = item['config'].copy()
+        manual_config['model_accuracy'] = 'high'
+        manual_config['enable_quality_check'] = True
+        return manual_config
+    return item['config']
+
+def prefetch_batch_detections(batch: List[Dict]) -> int:
+    """Run one batched GPU detection for a queued micro-batch and seed detection_cache with it"""
+    pending = []
+    for item in batch:
+        config = motion_pipeline_config(item)
+        model_type, _ = select_detection_model(config, item['motion_strength'])
+        detection_scale = select_detection_scale(config)
+        cache_key = (image_digest(item['image_data']), model_type, detection_scale)
+        if get_cached_detection(cache_key) is None:
+            pending.append((item, cache_key, detection_scale))
+    
+    if len(pending) < 2:
+        return 0
+    
+    images = [decode_image_rgb(item['image_data']) for item, _, _ in pending]
+    batch_locations = detect_faces_batch(images, [detection_scale for _, _, detection_scale in pending])
+    
+    for (item, cache_key, _), image_array, locations in zip(pending, images, batch_locations):
+        store_cached_detection(cache_key, {'locations': locations, 'encodings': {}})
+        item['image_array'] = image_array  # Spare the pipeline a second decode
+    
+    return len(pending)
+
+def detect_and_encode_faces(image_array: np.ndarray, config: Dict, motion_strength: float, image_data: Optional[bytes] = None, session_id: Optional[str] = None) -> tuple:
+    """Detect, quality-score and encode faces, returns (locations, encodings, quality_scores, seconds)"""
+    start_time = time.time()
+    model_type, num_jitters = select_detection_model(config, motion_strength)
+    detection_scale = select_detection_scale(config)
+    
+    # Detect faces (reusing the endpoint's quick count or an identical earlier upload)
+    cache_key = (image_digest(image_data), model_type, detection_scale) if image_data is not None and DETECTION_CACHE_SIZE > 0 else None
+    cached = get_cached_detection(cache_key) if cache_key else None
+    if cached is not None:
+        face_locations = cached['locations']
+        known_encodings = dict(cached['encodings'])
+        logger.info("♻️ Reusing cached face detection")
+    else:
+        if FRAME_REUSE_GRID > 0 and session_id is not None:
+            face_locations = detect_faces_with_frame_reuse(image_array, session_id, model_type, detection_scale)
+        else:
+            face_locations = detect_faces(image_array, model=model_type, scale=detection_scale)
+        known_encodings = {}
+    detected_locations = face_locations
+    
+    if not face_locations:
+        if cache_key:
+            store_cached_detection(cache_key, {'locations': detected_locations, 'encodings': known_encodings})
+        logger.info("No faces detected in motion-triggered processing")
+        return [], [], [], time.time() - start_time
+    
+    logger.info(f"🎯 Motion processing: detected {len(face_locations)} faces (motion: {motion_strength:.3f}, model: {model_type})")
+    
+    # Score quality before encoding so low-quality faces skip the ResNet pass
+    quality_scores = [1.0] * len(face_locations)
+    if config.get('enable_quality_check', False) or MIN_FACE_QUALITY > 0:
+        quality_scores = [
+            calculate_motion_face_quality(image_array, location, motion_strength)['overall_score']
+            for location in face_locations
+        ]
+    
+    if MIN_FACE_QUALITY > 0:
+        kept = [(location, quality) for location, quality in zip(face_locations, quality_scores) if quality >= MIN_FACE_QUALITY]
+        skipped = len(face_locations) - len(kept)
+        if skipped:
+            logger.info(f"⏭️ Skipped {skipped} low-quality faces (< {MIN_FACE_QUALITY})")
+        face_locations = [location for location, _ in kept]
+        quality_scores = [quality for _, quality in kept]
+        if not config.get('enable_quality_check', False):
+            quality_scores = [1.0] * len(face_locations)
+    
+    # Get face encodings (only for faces not already encoded for this image)
+    missing_locations = [location for location in face_locations if (location, num_jitters) not in known_encodings]
+    if missing_locations:
+        new_encodings = encode_faces_with_crop_cache(image_array, missing_locations, num_jitters, session_id)
+        known_encodings.update(((location, num_jitters), encoding) for location, encoding in zip(missing_locations, new_encodings))
+        if cache_key:
+            store_cached_detection(cache_key, {'locations': detected_locations, 'encodings': known_encodings})
+    face_encodings = [known_encodings[(location, num_jitters)] for location in face_locations]
+    
+    return face_locations, face_encodings, quality_scores, time.time() - start_time
+
+def detect_and_encode_image(image_data: bytes, config: Dict, motion_strength: float) -> tuple:
+    """Worker-process entry point: decode the upload and run detect_and_encode_faces"""
+    return detect_and_encode_faces(decode_image_rgb(image_data), config, motion_strength, image_data)
+
+def process_motion_triggered_faces(image_array: Optional[np.ndarray], enrolled_students: List[str], config: Dict, motion_strength: float, image_data: Optional[bytes] = None, detection: Optional[tuple] = None, session_id: Optional[str] = None) -> List[Dict]:
     """Process faces with motion-specific optimizations"""
     try:
         start_time = time.time()
         
-        if image_array is None or image_array.size == 0:
+        if detection is None and (image_array is None or image_array.size == 0):
             logger.warning("Empty image array for motion processing")
             return []
         
@@ -371,29 +910,21 @@ def process_motion_triggered_faces(image_array: np.ndarray, enrolled_students: L
             logger.warning("No enrolled students for motion processing")
             return []
         
-        # Choose model based on motion strength and config
-        if motion_strength > 0.3 and config.get('motion_boost', False):
-            model_type = "cnn"  # Use high-accuracy model for strong motion
-            num_jitters = 2
-        else:
-            model_type = "cnn" if config['model_accuracy'] == 'high' else "hog"
-            num_jitters = 2 if config['model_accuracy'] == 'high' else 1
+        model_type, _ = select_detection_model(config, motion_strength)
         
-        # Detect faces
-        face_locations = face_recognition.face_locations(image_array, model=model_type)
+        # Detection may already have run in a worker process
+        if detection is None:
+            face_locations, face_encodings, quality_scores, _ = detect_and_encode_faces(image_array, config, motion_strength, image_data, session_id)
+        else:
+            face_locations, face_encodings, quality_scores, detection_seconds = detection
+            start_time -= detection_seconds  # Count the worker's time in processing_time
         
         if not face_locations:
-            logger.info("No faces detected in motion-triggered processing")
             return []
         
-        logger.info(f"🎯 Motion processing: detected {len(face_locations)} faces (motion: {motion_strength:.3f}, model: {model_type})")
-        
-        # Get face encodings
-        face_encodings = face_recognition.face_encodings(
-            image_array, 
-            face_locations, 
-            num_jitters=num_jitters
-        )
+        # Stack all enrolled embeddings once so each face is matched with a single matrix product
+        enrolled_matrix, enrolled_ids, enrolled_sq = build_embedding_matrix(enrolled_students)
+        similarity_matrix = calculate_similarity_matrix(np.asarray(face_encodings), enrolled_matrix, enrolled_sq)
         
         detected_faces = []
         threshold = config['face_threshold']
@@ -409,23 +940,14 @@ def process_motion_triggered_faces(image_array: np.ndarray, enrolled_students: L
                 best_match = None
                 best_similarity = 0.0
                 
-                # Compare with enrolled students
-                for student_id in enrolled_students:
-                    stored_embedding = get_face_embedding_cached(student_id)
-                    if stored_embedding is None:
-                        continue
-                    
-                    similarity = calculate_enhanced_similarity(stored_embedding, encoding)
-                    
-                    if similarity > threshold and similarity > best_similarity:
-                        best_similarity = similarity
-                        best_match = student_id
+                # Pick the best enrolled student for this face
+                if enrolled_ids:
+                    best_index = int(np.argmax(similarity_matrix[i]))
+                    if similarity_matrix[i, best_index] > threshold:
+                        best_similarity = float(similarity_matrix[i, best_index])
+                        best_match = enrolled_ids[best_index]
                 
-                # Enhanced quality check for motion-triggered captures
-                quality_score = 1.0
-                if config.get('enable_quality_check', False):
-                    quality_info = calculate_motion_face_quality(image_array, location, motion_strength)
-                    quality_score = quality_info['overall_score']
+                quality_score = quality_scores[i]
                 
                 face_info = {
                     'face_index': i,
@@ -460,6 +982,43 @@ def process_motion_triggered_faces(image_array: np.ndarray, enrolled_students: L
         logger.error(f"Error in motion-triggered face processing: {e}")
         return []
 
+def process_enrollment_image(image_data: bytes, idx: int) -> Optional[tuple]:
+    """Detect and encode the largest face of one enrollment image, returns (encoding, quality) or None"""
+    try:
+        image_array = decode_image_rgb(image_data)
+        
+        # Use CNN model for enrollment (highest accuracy)
+        face_locations = detect_faces(image_array, model="cnn")
+        
+        if len(face_locations) == 0:
+            logger.warning(f"No face detected in enrollment image {idx + 1}")
+            return None
+        
+        if len(face_locations) > 1:
+            logger.warning(f"Multiple faces detected in enrollment image {idx + 1}, using the largest one")
+            # Sort by face size and use the largest
+            face_locations = sorted(face_locations, key=lambda loc: (loc[2]-loc[0])*(loc[1]-loc[3]), reverse=True)
+        
+        # Get high-quality face encoding
+        face_encodings = face_recognition.face_encodings(
+            image_array, 
+            face_locations[:1], 
+            num_jitters=ENROLL_NUM_JITTERS  # Higher jitters for better enrollment
+        )
+        
+        if not face_encodings:
+            return None
+        
+        # Calculate quality for this enrollment image
+        quality = calculate_face_quality(image_array, face_locations[0])
+        logger.info(f"✅ Processed enrollment image {idx + 1} (quality: {quality['overall_score']:.3f})")
+        
+        return face_encodings[0], quality['overall_score']
+        
+    except Exception as e:
+        logger.error(f"Error processing enrollment image {idx + 1}: {e}")
+        return None
+
 def calculate_motion_face_quality(image_array: np.ndarray, face_location: tuple, motion_strength: float) -> Dict[str, float]:
     """Calculate face quality with motion considerations"""
     try:
@@ -496,13 +1055,15 @@ def calculate_face_quality(image_array: np.ndarray, face_location: tuple) -> Dic
         
         gray_face = cv2.cvtColor(face_image, cv2.COLOR_RGB2GRAY)
         
-        # Basic quality metrics
-        brightness = np.mean(gray_face) / 255.0
-        contrast = np.std(gray_face) / 255.0
+        # Basic quality metrics (mean and std in one SIMD pass)
+        gray_mean, gray_std = cv2.meanStdDev(gray_face)
+        brightness = float(gray_mean[0, 0]) / 255.0
+        contrast = float(gray_std[0, 0]) / 255.0
         
-        # Sharpness using Laplacian
-        laplacian = cv2.Laplacian(gray_face, cv2.CV_64F)
-        sharpness = np.var(laplacian) / 10000.0
+        # Sharpness using Laplacian variance (int16 output is exact for uint8 input)
+        laplacian = cv2.Laplacian(gray_face, cv2.CV_16S)
+        _, laplacian_std = cv2.meanStdDev(laplacian)
+        sharpness = float(laplacian_std[0, 0]) ** 2 / 10000.0
         
         # Face size score
         face_area = (right - left) * (bottom - top)
@@ -530,45 +1091,98 @@ def calculate_face_quality(image_array: np.ndarray, face_location: tuple) -> Dic
         logger.error(f"Error calculating face quality: {e}")
         return {"overall_score": 0.0}
 
-def calculate_enhanced_similarity(embedding1: np.ndarray, embedding2: np.ndarray) -> float:
-    """Enhanced similarity calculation for motion-triggered processing"""
-    try:
-        # Euclidean distance
-        euclidean_distance = np.linalg.norm(embedding1 - embedding2)
-        euclidean_score = max(0, 1 - euclidean_distance)
-        
-        # Cosine similarity
-        dot_product = np.dot(embedding1, embedding2)
-        norm_a = np.linalg.norm(embedding1)
-        norm_b = np.linalg.norm(embedding2)
-        
-        if norm_a == 0 or norm_b == 0:
-            cosine_similarity = 0
-        else:
-            cosine_similarity = dot_product / (norm_a * norm_b)
-        
-        # Weighted combination optimized for motion-triggered processing
-        final_score = (euclidean_score * 0.4 + cosine_similarity * 0.6)
-        
-        return float(np.clip(final_score, 0, 1))
-        
-    except Exception as e:
-        logger.error(f"Error calculating similarity: {e}")
-        return 0.0
+def build_embedding_matrix(student_ids: List[str]) -> tuple:
+    """Stack cached embeddings into an (S, D) float32 matrix, returns (matrix, ids, squared norms)"""
+    roster_key = tuple(student_ids)
+    with cache_lock:
+        cached = roster_matrix_cache.get(roster_key)
+        if cached is not None:
+            matrix, ids, squared_norms, built_at = cached
+            if time.monotonic() - built_at < FACE_CACHE_TTL_SECONDS:
+                roster_matrix_cache.move_to_end(roster_key)
+                return matrix, ids, squared_norms
+            del roster_matrix_cache[roster_key]
+    
+    embeddings, fetch_succeeded = warm_face_cache(student_ids)
+    ids = []
+    rows = []
+    for student_id in student_ids:
+        embedding = embeddings.get(student_id)
+        if embedding is not None:
+            ids.append(student_id)
+            rows.append(embedding)
+    
+    if not rows:
+        return np.empty((0, 0), dtype=np.float32), [], np.empty(0, dtype=np.float32)
+    
+    matrix = np.vstack(rows).astype(np.float32, copy=False)
+    squared_norms = np.einsum('ij,ij->i', matrix, matrix)
+    
+    # A failed fetch leaves the matrix partial; cache only complete rosters so the next capture retries
+    if fetch_succeeded:
+        with cache_lock:
+            roster_matrix_cache[roster_key] = (matrix, ids, squared_norms, time.monotonic())
+            # Every roster change is a new key, so bound the cache to one roster per possible session
+            while len(roster_matrix_cache) > MAX_MOTION_SESSIONS:
+                roster_matrix_cache.popitem(last=False)
+    
+    return matrix, ids, squared_norms
+
+def calculate_similarity_matrix(encodings: np.ndarray, enrolled_matrix: np.ndarray, enrolled_sq: Optional[np.ndarray] = None) -> np.ndarray:
+    """Similarity (0.4 Euclidean + 0.6 cosine, or SIMILARITY_METRIC) for every (face, student) pair"""
+    if encodings.size == 0 or enrolled_matrix.size == 0:
+        return np.zeros((len(encodings), len(enrolled_matrix)), dtype=np.float32)
+    
+    queries = encodings.astype(np.float32, copy=False)
+    dots = queries @ enrolled_matrix.T
+    query_sq = np.einsum('ij,ij->i', queries, queries)
+    if enrolled_sq is None:
+        enrolled_sq = np.einsum('ij,ij->i', enrolled_matrix, enrolled_matrix)
+    
+    # Cosine similarity
+    denom = np.sqrt(query_sq[:, None] * enrolled_sq[None, :])
+    cosine_similarity = np.divide(dots, denom, out=np.zeros_like(dots), where=denom != 0)
+    
+    if SIMILARITY_METRIC == "cosine":
+        return np.clip(cosine_similarity, 0, 1)
+    
+    # Euclidean distance via ||a||^2 + ||b||^2 - 2ab
+    squared_distance = np.maximum(query_sq[:, None] + enrolled_sq[None, :] - 2 * dots, 0)
+    euclidean_score = np.maximum(0, 1 - np.sqrt(squared_distance))
+    
+    return np.clip(euclidean_score * 0.4 + cosine_similarity * 0.6, 0, 1)
 
 async def get_enrolled_students_for_class(class_id: str) -> List[str]:
     """Get enrolled students with caching"""
+    with cache_lock:
+        cached = class_roster_cache.get(class_id)
+        if cached is not None:
+            student_ids, cached_at = cached
+            if time.monotonic() - cached_at < CLASS_ROSTER_TTL_SECONDS:
+                return student_ids
+            del class_roster_cache[class_id]
+    
     try:
-        result = supabase.table('class_students').select('users(school_id)').eq('class_id', class_id).execute()
+        result = await run_supabase(supabase.table('class_students').select('users(school_id, email)').eq('class_id', class_id))
         
         if not result.data:
             logger.warning(f"No enrolled students found for class {class_id}")
             return []
         
         student_ids = []
+        emails = {}
         for record in result.data:
             if record and record.get('users') and record['users'].get('school_id'):
                 student_ids.append(record['users']['school_id'])
+                if record['users'].get('email'):
+                    emails[record['users']['school_id']] = record['users']['email']
+        
+        # Emails come along with the roster, so recognized faces need no users lookup
+        cached_at = time.monotonic()
+        with cache_lock:
+            class_roster_cache[class_id] = (student_ids, cached_at)
+            for school_id, email in emails.items():
+                student_email_cache[school_id] = (email, cached_at)
         
         logger.info(f"Found {len(student_ids)} enrolled students for class {class_id}")
         return student_ids
@@ -577,6 +1191,208 @@ async def get_enrolled_students_for_class(class_id: str) -> List[str]:
         logger.error(f"Error getting enrolled students for class {class_id}: {e}")
         return []
 
+def determine_capture_status(capture_time: str, session_data: Dict) -> str:
+    """'present' if the capture falls within the session's on-time window, else 'late'"""
+    capture_dt = datetime.fromisoformat(capture_time.replace('Z', '+00:00'))
+    session_start = datetime.fromisoformat(session_data['start_time'].replace('Z', '+00:00'))
+    on_time_limit = session_start + timedelta(minutes=session_data['on_time_limit_minutes'])
+    return 'present' if capture_dt <= on_time_limit else 'late'
+
+async def run_motion_face_pipeline(item: Dict, config: Dict, motion_strength: float) -> Optional[List[Dict]]:
+    """Decode, detect and match a queued capture; None when the class has no enrolled students"""
+    loop = asyncio.get_running_loop()
+    image_data = item['image_data']
+    
+    # Image work overlaps the enrolled-students round-trip
+    if process_executor is not None:
+        detection, enrolled_students = await asyncio.gather(
+            loop.run_in_executor(process_executor, detect_and_encode_image, image_data, config, motion_strength),
+            get_enrolled_students_for_class(item['session_data']['class_id'])
+        )
+        image_array = None
+    else:
+        if item.get('image_array') is not None:
+            image_array = item['image_array']
+            enrolled_students = await get_enrolled_students_for_class(item['session_data']['class_id'])
+        else:
+            image_array, enrolled_students = await asyncio.gather(
+                loop.run_in_executor(executor, decode_image_rgb, image_data),
+                get_enrolled_students_for_class(item['session_data']['class_id'])
+            )
+        detection = None
+    
+    if not enrolled_students:
+        return None
+    
+    return await loop.run_in_executor(
+        executor,
+        process_motion_triggered_faces,
+        image_array,
+        enrolled_students,
+        config,
+        motion_strength,
+        image_data,
+        detection,
+        item['session_id']
+    )
+
+def session_write_lock(session_id: str) -> asyncio.Lock:
+    """Per-session lock around the duplicate check and attendance insert"""
+    lock = session_write_locks.get(session_id)
+    if lock is None:
+        # Drop idle locks of finished sessions before adding one
+        if len(session_write_locks) >= MAX_MOTION_SESSIONS:
+            for idle_id in [sid for sid, idle in session_write_locks.items() if not idle.locked()]:
+                del session_write_locks[idle_id]
+        lock = session_write_locks[session_id] = asyncio.Lock()
+    return lock
+
+async def get_student_emails(student_ids: List[str]) -> Dict[str, str]:
+    """Map school_id -> email for many students, querying only ids missing from the cache"""
+    emails = {}
+    missing = set()
+    now = time.monotonic()
+    with cache_lock:
+        for student_id in student_ids:
+            cached = student_email_cache.get(student_id)
+            if cached is not None and now - cached[1] < CLASS_ROSTER_TTL_SECONDS:
+                emails[student_id] = cached[0]
+            else:
+                missing.add(student_id)
+    
+    if missing:
+        result = await run_supabase(supabase.table('users').select('school_id, email').in_('school_id', list(missing)))
+        cached_at = time.monotonic()
+        with cache_lock:
+            for row in result.data or []:
+                emails[row['school_id']] = row['email']
+                student_email_cache[row['school_id']] = (row['email'], cached_at)
+    
+    return emails
+
+async def get_recorded_emails(session_id: str, student_emails: List[str]) -> set:
+    """Return which of these students already have an attendance record in the session"""
+    if not student_emails:
+        return set()
+    
+    result = await run_supabase(supabase.table('attendance_records').select('student_email').eq('session_id', session_id).in_('student_email', list(set(student_emails))))
+    return {row['student_email'] for row in result.data or []}
+
+async def insert_attendance_records(records: List[Dict], source: str) -> int:
+    """Insert attendance records in one request, falling back to per-record inserts on failure"""
+    if not records:
+        return 0
+    
+    try:
+        await run_supabase(supabase.table('attendance_records').insert(records))
+        logger.info(f"✅ {source} attendance recorded for {len(records)} students")
+        return len(records)
+    except Exception as e:
+        logger.warning(f"⚠️ Bulk insert of {len(records)} {source} records failed, retrying individually: {e}")
+    
+    inserted = 0
+    for record in records:
+        try:
+            await run_supabase(supabase.table('attendance_records').insert(record))
+            inserted += 1
+        except Exception as e:
+            logger.error(f"❌ Error saving {source} record for {record.get('student_id')}: {e}")
+    return inserted
+
+def spawn_server_task(coro) -> asyncio.Task:
+    """Start a tracked background task that is cancelled on shutdown"""
+    task = asyncio.create_task(coro)
+    server_tasks.add(task)
+    task.add_done_callback(server_tasks.discard)
+    return task
+
+def persist_face_cache() -> int:
+    """Write face_cache to FACE_CACHE_PATH as an (S, D) float32 matrix plus student ids and cache times"""
+    if not FACE_CACHE_PATH:
+        return 0
+    
+    with cache_lock:
+        items = [(student_id, embedding, cached_at) for student_id, (embedding, cached_at) in face_cache.items()]
+    
+    # monotonic() does not survive a restart, so store when each row was cached in wall-clock time
+    wall_offset = time.time() - time.monotonic()
+    ids = [student_id for student_id, _, _ in items]
+    cached_times = [cached_at + wall_offset for _, _, cached_at in items]
+    matrix = np.vstack([embedding for _, embedding, _ in items]).astype(np.float32) if items else np.empty((0, 128), dtype=np.float32)
+    
+    # Write to temp files then swap in; the two swaps are not atomic together, so the .json
+    # records a digest of the matrix and a crash between them is caught on load
+    with open(f"{FACE_CACHE_PATH}.npy.tmp", 'wb') as f:
+        np.save(f, matrix)
+    with open(f"{FACE_CACHE_PATH}.json.tmp", 'w') as f:
+        json.dump({'ids': ids, 'cached_at': cached_times, 'matrix_digest': hashlib.blake2b(matrix.tobytes(), digest_size=16).hexdigest()}, f)
+    os.replace(f"{FACE_CACHE_PATH}.npy.tmp", f"{FACE_CACHE_PATH}.npy")
+    os.replace(f"{FACE_CACHE_PATH}.json.tmp", f"{FACE_CACHE_PATH}.json")
+    
+    return len(ids)
+
+def load_persisted_face_cache() -> int:
+    """Populate face_cache from the last snapshot, if any"""
+    if not FACE_CACHE_PATH or not os.path.exists(f"{FACE_CACHE_PATH}.npy") or not os.path.exists(f"{FACE_CACHE_PATH}.json"):
+        return 0
+    
+    matrix = np.load(f"{FACE_CACHE_PATH}.npy", mmap_mode='r')
+    with open(f"{FACE_CACHE_PATH}.json") as f:
+        metadata = json.load(f)
+    
+    if not isinstance(metadata, dict):
+        logger.warning("⚠️ Face cache snapshot has no cache times (old format), ignoring it")
+        return 0
+    
+    ids = metadata.get('ids', [])
+    cached_times = metadata.get('cached_at', [])
+    if len(ids) != len(matrix) or len(cached_times) != len(ids):
+        logger.warning(f"⚠️ Face cache snapshot is inconsistent ({len(ids)} ids, {len(matrix)} rows), ignoring it")
+        return 0
+    
+    # Rows follow LRU order, so a matrix from another snapshot could map students to the wrong embeddings
+    if metadata.get('matrix_digest') != hashlib.blake2b(matrix.tobytes(), digest_size=16).hexdigest():
+        logger.warning("⚠️ Face cache snapshot matrix does not match its ids, ignoring it")
+        return 0
+    
+    # Restored rows keep their real age, and rows already past the TTL are dropped
+    now_wall = time.time()
+    now_monotonic = time.monotonic()
+    restored = 0
+    with cache_lock:
+        for i, student_id in enumerate(ids):
+            age = max(0.0, now_wall - cached_times[i])
+            if age >= FACE_CACHE_TTL_SECONDS or student_id in face_cache:
+                continue
+            # Copy the row out so the cache holds no view keeping the .npy mapped (blocks os.replace on Windows)
+            cache_face_embedding(student_id, np.array(matrix[i]), now_monotonic - age)
+            restored += 1
+    
+    return restored
+
+async def persist_face_cache_periodically():
+    """Snapshot face_cache to disk whenever its contents change"""
+    last_version = None
+    while True:
+        await asyncio.sleep(FACE_CACHE_PERSIST_SECONDS)
+        try:
+            with cache_lock:
+                version = face_cache_version
+            if version != last_version:
+                await asyncio.to_thread(persist_face_cache)
+                last_version = version
+        except Exception as e:
+            logger.error(f"❌ Face cache persist error: {e}")
+
+async def reap_stale_motion_sessions():
+    """Periodically drop motion sessions that were never ended"""
+    while True:
+        await asyncio.sleep(600)
+        try:
+            motion_session_manager.remove_stale_sessions(timedelta(hours=MOTION_SESSION_MAX_AGE_HOURS))
+        except Exception as e:
+            logger.error(f"❌ Stale motion session cleanup error: {e}")
+
 # ==================== Motion Detection API Endpoints ====================
 
 @app.on_event("startup")
@@ -594,21 +1410,57 @@ async def startup_event():
     
     # Test face_recognition
     try:
-        test_array = np.zeros((50, 50, 3), dtype=np.uint8)
+        test_array = np.zeros((150, 150, 3), dtype=np.uint8)
         face_recognition.face_locations(test_array)
+        # Run one ResNet pass so model/CUDA initialisation is not paid by the first capture
+        compute_face_encodings(test_array, [(0, 150, 150, 0)])
         logger.info("✅ Face recognition library working")
+        logger.info(f"🖥️ dlib CUDA: {'Enabled' if DLIB_CUDA_AVAILABLE else 'Disabled'}, AVX: {'Enabled' if getattr(dlib, 'USE_AVX_INSTRUCTIONS', False) else 'Disabled'}")
+        if DLIB_CUDA_AVAILABLE:
+            logger.info(f"🖥️ dlib CUDA devices: {dlib.cuda.get_num_devices()}")
+        elif getattr(dlib, "DLIB_USE_CUDA", False):
+            logger.info("🖥️ dlib CUDA build present but disabled via USE_GPU=0")
     except Exception as e:
         logger.error(f"❌ Face recognition test failed: {e}")
     
+    if YUNET_MODEL_PATH and not YUNET_ENABLED:
+        logger.warning(f"⚠️ YuNet model not found at {YUNET_MODEL_PATH}, falling back to dlib HOG")
+    logger.info(f"🔍 Fast face detector: {'YuNet' if YUNET_ENABLED else 'dlib HOG'}")
+    
+    # Make sure OpenCV takes its SIMD paths and does not oversubscribe the thread pool
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(OPENCV_NUM_THREADS)
+    cpu_features = [line.strip() for line in cv2.getBuildInformation().splitlines() if 'CPU/HW features' in line or 'Baseline' in line or 'Dispatched code' in line]
+    logger.info(f"⚙️ OpenCV optimized: {cv2.useOptimized()}, threads: {cv2.getNumThreads()}, {' | '.join(cpu_features)}")
+    
     # Test Supabase connection
     try:
-        supabase.table('users').select("count", count='exact').limit(1).execute()
+        await run_supabase(supabase.table('users').select("count", count='exact').limit(1))
         logger.info("✅ Supabase connection working")
     except Exception as e:
         logger.error(f"❌ Supabase connection test failed: {e}")
     
-    # Start background motion processing queue
-    asyncio.create_task(process_motion_queue())
+    # Warm face_cache from the last snapshot
+    try:
+        restored = await asyncio.to_thread(load_persisted_face_cache)
+        if restored:
+            logger.info(f"💾 Restored {restored} face embeddings from {FACE_CACHE_PATH}")
+    except Exception as e:
+        logger.error(f"❌ Failed to restore face cache snapshot: {e}")
+    
+    # Worker processes for detection/encoding (spawned, so they never inherit the event loop or threads)
+    global process_executor
+    if MOTION_PROCESS_WORKERS > 0:
+        process_executor = ProcessPoolExecutor(max_workers=MOTION_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"🧵 Face detection worker processes: {MOTION_PROCESS_WORKERS}")
+        if FRAME_REUSE_GRID > 0:
+            logger.warning("⚠️ FRAME_REUSE_GRID is ignored while MOTION_PROCESS_WORKERS > 0 (frame history is per process)")
+    
+    # Start background motion processing queue and stale session reaper
+    spawn_server_task(process_motion_queue())
+    spawn_server_task(reap_stale_motion_sessions())
+    if FACE_CACHE_PATH:
+        spawn_server_task(persist_face_cache_periodically())
     
     logger.info(f"✅ Motion Detection Server startup complete")
     logger.info(f"📊 Motion Detection: {'Enabled' if MOTION_DETECTION_ENABLED else 'Disabled'}")
@@ -621,10 +1473,24 @@ async def shutdown_event():
     """Cleanup on shutdown"""
     logger.info("🛑 Shutting down Motion Detection Server...")
     
+    for task in list(server_tasks):
+        task.cancel()
+    await asyncio.gather(*server_tasks, return_exceptions=True)
+    
+    try:
+        persist_face_cache()
+    except Exception as e:
+        logger.error(f"❌ Failed to persist face cache on shutdown: {e}")
+    
     with cache_lock:
         face_cache.clear()
+        roster_matrix_cache.clear()
+        class_roster_cache.clear()
+        student_email_cache.clear()
     
     executor.shutdown(wait=True)
+    if process_executor is not None:
+        process_executor.shutdown(wait=True)
     logger.info("✅ Motion Detection Server shutdown complete")
 
 @app.post("/api/session/start-motion-detection")
@@ -646,13 +1512,13 @@ async def start_motion_detection_session(
         logger.info(f"🎯 Starting motion detection session for {class_id} by {teacher_email}")
         
         # Validate class and teacher
-        class_result = supabase.table('classes').select('*').eq('class_id', class_id).eq('teacher_email', teacher_email).single().execute()
+        class_result = await run_supabase(supabase.table('classes').select('*').eq('class_id', class_id).eq('teacher_email', teacher_email).single())
         
         if not class_result.data:
             raise HTTPException(status_code=404, detail="Class not found or you are not the teacher")
         
         # Check for existing active session
-        existing_session = supabase.table('attendance_sessions').select('id').eq('class_id', class_id).eq('status', 'active').execute()
+        existing_session = await run_supabase(supabase.table('attendance_sessions').select('id').eq('class_id', class_id).eq('status', 'active'))
         
         if existing_session.data:
             raise HTTPException(status_code=400, detail="There is already an active session for this class")
@@ -679,7 +1545,7 @@ async def start_motion_detection_session(
             'created_at': start_time.isoformat()
         }
         
-        session_result = supabase.table('attendance_sessions').insert(session_data).execute()
+        session_result = await run_supabase(supabase.table('attendance_sessions').insert(session_data))
         
         if not session_result.data:
             raise HTTPException(status_code=500, detail="Failed to create motion detection session")
@@ -697,12 +1563,25 @@ async def start_motion_detection_session(
         
         motion_session_manager.create_session(session_id, motion_config)
         
+        # Log session start before queueing, so the background pass always finds the row to update
+        capture_log = {
+            'session_id': session_id,
+            'capture_time': start_time.isoformat(),
+            'capture_type': 'session_start',
+            'trigger_type': 'manual',
+            'motion_strength': 1.0,
+            'processing_status': 'queued',
+            'created_at': start_time.isoformat()
+        }
+        
+        await run_supabase(supabase.table('motion_captures').insert(capture_log))
+        
         # Process initial image if provided
         if initial_image:
             image_data = await initial_image.read()
             
             # Add to processing queue with highest priority
-            await motion_processing_queue.put({
+            queued = await motion_processing_queue.put({
                 "priority": 1,
                 "image_data": image_data,
                 "session_id": session_id,
@@ -713,19 +1592,13 @@ async def start_motion_detection_session(
                 "motion_strength": 1.0,  # Full strength for manual start
                 "session_data": session_data
             })
-        
-        # Log session start
-        capture_log = {
-            'session_id': session_id,
-            'capture_time': start_time.isoformat(),
-            'capture_type': 'session_start',
-            'trigger_type': 'manual',
-            'motion_strength': 1.0,
-            'processing_status': 'queued',
-            'created_at': start_time.isoformat()
-        }
-        
-        supabase.table('motion_captures').insert(capture_log).execute()
+            
+            if not queued:
+                logger.warning(f"📦 Motion queue full, initial image skipped for session {session_id}")
+                await run_supabase(supabase.table('motion_captures').update({
+                    'processing_status': 'blocked',
+                    'block_reason': 'queue_full'
+                }).eq('session_id', session_id).eq('capture_time', start_time.isoformat()))
         
         logger.info(f"✅ Motion detection session started: {session_id}")
         
@@ -764,7 +1637,7 @@ async def process_motion_triggered_snapshot(
             raise HTTPException(status_code=400, detail="Motion detection is disabled")
         
         # Validate active motion session
-        session_result = supabase.table('attendance_sessions').select('*').eq('id', session_id).eq('status', 'active').eq('session_type', 'motion_detection').single().execute()
+        session_result = await run_supabase(supabase.table('attendance_sessions').select('*').eq('id', session_id).eq('status', 'active').eq('session_type', 'motion_detection').single())
         
         if not session_result.data:
             raise HTTPException(status_code=404, detail="Active motion detection session not found")
@@ -793,7 +1666,7 @@ async def process_motion_triggered_snapshot(
                 'created_at': datetime.now().isoformat()
             }
             
-            supabase.table('motion_captures').insert(capture_log).execute()
+            await run_supabase(supabase.table('motion_captures').insert(capture_log))
             
             return {
                 "success": False,
@@ -816,13 +1689,41 @@ async def process_motion_triggered_snapshot(
         
         # Process image data
         image_data = await image.read()
+        # One timestamp for both the queue item and the capture log, so the background
+        # pass can find the log row again by (session_id, capture_time)
+        capture_time = datetime.now().isoformat()
+        
+        # Quick face detection for immediate response (off the event loop); runs before
+        # queueing so a HOG background pass can reuse the detection
+        try:
+            quick_model, _ = select_detection_model(config, motion_strength)
+            faces_detected = await asyncio.get_running_loop().run_in_executor(executor, count_faces, image_data, quick_model, select_detection_scale(config), session_id)
+        except:
+            faces_detected = 0
+        
+        # Log motion capture before queueing, so the background pass always finds the row to update
+        capture_log = {
+            'session_id': session_id,
+            'capture_time': capture_time,
+            'capture_type': 'motion_triggered',
+            'trigger_type': 'motion',
+            'motion_strength': motion_strength,
+            'processing_phase': phase,
+            'faces_detected': faces_detected,
+            'processing_status': 'queued',
+            'queue_priority': priority,
+            'device_id': device_id,
+            'created_at': datetime.now().isoformat()
+        }
+        
+        await run_supabase(supabase.table('motion_captures').insert(capture_log))
         
         # Add to motion processing queue
-        await motion_processing_queue.put({
+        queued = await motion_processing_queue.put({
             "priority": priority,
             "image_data": image_data,
             "session_id": session_id,
-            "capture_time": datetime.now().isoformat(),
+            "capture_time": capture_time,
             "phase": phase,
             "config": config,
             "processing_type": "motion_triggered",
@@ -833,38 +1734,27 @@ async def process_motion_triggered_snapshot(
             "device_id": device_id
         })
         
-        # Quick face detection for immediate response
-        try:
-            image_pil = Image.open(io.BytesIO(image_data))
-            if image_pil.mode != 'RGB':
-                image_pil = image_pil.convert('RGB')
+        if not queued:
+            logger.warning(f"📦 Motion queue full, snapshot dropped for session {session_id}")
             
-            image_array = np.array(image_pil)
-            face_locations = face_recognition.face_locations(image_array, model="hog")
-            faces_detected = len(face_locations)
-        except:
-            faces_detected = 0
+            await run_supabase(supabase.table('motion_captures').update({
+                'processing_status': 'blocked',
+                'block_reason': 'queue_full'
+            }).eq('session_id', session_id).eq('capture_time', capture_time))
+            
+            return {
+                "success": False,
+                "message": "Motion detected but snapshot blocked: queue_full",
+                "session_id": session_id,
+                "motion_strength": motion_strength,
+                "block_reason": "queue_full",
+                "remaining_seconds": 0,
+                "motion_recorded": True
+            }
         
         # Update motion session - snapshot taken
         motion_session_manager.record_motion_event(session_id, motion_strength, snapshot_taken=True)
         
-        # Log motion capture
-        capture_log = {
-            'session_id': session_id,
-            'capture_time': datetime.now().isoformat(),
-            'capture_type': 'motion_triggered',
-            'trigger_type': 'motion',
-            'motion_strength': motion_strength,
-            'processing_phase': phase,
-            'faces_detected': faces_detected,
-            'processing_status': 'queued',
-            'queue_priority': priority,
-            'device_id': device_id,
-            'created_at': datetime.now().isoformat()
-        }
-        
-        supabase.table('motion_captures').insert(capture_log).execute()
-        
         return {
             "success": True,
             "message": f"Motion-triggered snapshot queued for processing",
@@ -897,7 +1787,7 @@ async def manual_motion_capture(
     """Manual capture by teacher during motion detection session"""
     try:
         # Validate motion detection session
-        session_result = supabase.table('attendance_sessions').select('*').eq('id', session_id).eq('status', 'active').eq('session_type', 'motion_detection').single().execute()
+        session_result = await run_supabase(supabase.table('attendance_sessions').select('*').eq('id', session_id).eq('status', 'active').eq('session_type', 'motion_detection').single())
         
         if not session_result.data:
             raise HTTPException(status_code=404, detail="Active motion detection session not found")
@@ -927,44 +1817,21 @@ async def manual_motion_capture(
         
         # Process image data
         image_data = await image.read()
+        capture_time = datetime.now().isoformat()
         
         # Manual captures get high priority
         priority = max(1, config['processing_priority'] - 1)
         
-        await motion_processing_queue.put({
-            "priority": priority,
-            "image_data": image_data,
-            "session_id": session_id,
-            "capture_time": datetime.now().isoformat(),
-            "phase": phase,
-            "config": config,
-            "processing_type": "manual_teacher_capture",
-            "trigger_type": "manual",
-            "motion_strength": 1.0,  # Full strength for manual
-            "session_data": session_data,
-            "elapsed_minutes": elapsed_minutes,
-            "force_capture": force_capture
-        })
-        
-        # Quick face detection for immediate response
+        # Quick face detection for immediate response (off the event loop)
         try:
-            image_pil = Image.open(io.BytesIO(image_data))
-            if image_pil.mode != 'RGB':
-                image_pil = image_pil.convert('RGB')
-            
-            image_array = np.array(image_pil)
-            face_locations = face_recognition.face_locations(image_array, model="hog")
-            faces_detected = len(face_locations)
+            faces_detected = await asyncio.get_running_loop().run_in_executor(executor, count_faces, image_data)
         except:
             faces_detected = 0
         
-        # Update motion session - manual snapshot taken
-        motion_session_manager.record_motion_event(session_id, 1.0, snapshot_taken=True)
-        
-        # Log manual capture
+        # Log manual capture before queueing, so the background pass always finds the row to update
         capture_log = {
             'session_id': session_id,
-            'capture_time': datetime.now().isoformat(),
+            'capture_time': capture_time,
             'capture_type': 'manual_teacher',
             'trigger_type': 'manual',
             'motion_strength': 1.0,
@@ -976,7 +1843,38 @@ async def manual_motion_capture(
             'created_at': datetime.now().isoformat()
         }
         
-        supabase.table('motion_captures').insert(capture_log).execute()
+        await run_supabase(supabase.table('motion_captures').insert(capture_log))
+        
+        queued = await motion_processing_queue.put({
+            "priority": priority,
+            "image_data": image_data,
+            "session_id": session_id,
+            "capture_time": capture_time,
+            "phase": phase,
+            "config": config,
+            "processing_type": "manual_teacher_capture",
+            "trigger_type": "manual",
+            "motion_strength": 1.0,  # Full strength for manual
+            "session_data": session_data,
+            "elapsed_minutes": elapsed_minutes,
+            "force_capture": force_capture
+        })
+        
+        if not queued:
+            logger.warning(f"📦 Motion queue full, manual capture dropped for session {session_id}")
+            await run_supabase(supabase.table('motion_captures').update({
+                'processing_status': 'blocked',
+                'block_reason': 'queue_full'
+            }).eq('session_id', session_id).eq('capture_time', capture_time))
+            return {
+                "success": False,
+                "message": "Manual capture blocked: queue_full",
+                "block_reason": "queue_full",
+                "force_capture_available": False
+            }
+        
+        # Update motion session - manual snapshot taken
+        motion_session_manager.record_motion_event(session_id, 1.0, snapshot_taken=True)
         
         return {
             "success": True,
@@ -996,26 +1894,61 @@ async def manual_motion_capture(
 
 # ==================== Background Motion Processing ====================
 
+async def collect_motion_batch() -> List[Dict]:
+    """Collect a micro-batch of queued motion items within the batching window"""
+    # Block until work arrives instead of polling
+    batch = [await motion_processing_queue.get()]
+    deadline = time.monotonic() + MOTION_BATCH_WINDOW_MS / 1000.0
+    
+    while len(batch) < MOTION_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(motion_processing_queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    
+    return batch
+
+async def dispatch_motion_item(item: Dict):
+    """Route a queued motion item to its processor"""
+    if item['processing_type'] == 'session_start':
+        await process_motion_session_start(item)
+    elif item['processing_type'] == 'motion_triggered':
+        await process_motion_triggered_background(item)
+    elif item['processing_type'] == 'manual_teacher_capture':
+        await process_manual_teacher_motion_capture(item)
+    else:
+        logger.warning(f"Unknown motion processing type: {item.get('processing_type')}")
+
 async def process_motion_queue():
     """Background processor for motion-triggered attendance queue"""
     logger.info("🔄 Starting motion processing queue...")
     
     while True:
         try:
-            item = await motion_processing_queue.get()
-            if not item:
-                await asyncio.sleep(1)
-                continue
+            batch = await collect_motion_batch()
             
-            # Process item based on type
-            if item['processing_type'] == 'session_start':
-                await process_motion_session_start(item)
-            elif item['processing_type'] == 'motion_triggered':
-                await process_motion_triggered_background(item)
-            elif item['processing_type'] == 'manual_teacher_capture':
-                await process_manual_teacher_motion_capture(item)
-            else:
-                logger.warning(f"Unknown motion processing type: {item.get('processing_type')}")
+            if len(batch) > 1:
+                logger.info(f"📦 Processing motion batch of {len(batch)} items")
+            
+            # Detect the whole batch in one GPU pass; the per-item pipelines then hit detection_cache
+            if len(batch) > 1 and DLIB_CUDA_AVAILABLE and process_executor is None and DETECTION_CACHE_SIZE > 0:
+                try:
+                    prefetched = await asyncio.get_running_loop().run_in_executor(executor, prefetch_batch_detections, batch)
+                    if prefetched:
+                        logger.info(f"🖥️ Batched GPU detection for {prefetched} frames")
+                except Exception as e:
+                    logger.error(f"❌ Batched GPU detection failed, falling back to per-frame detection: {e}")
+            
+            # Items are dispatched together so their Supabase I/O overlaps; dlib holds the GIL, so on the
+            # thread pool detection/encoding still runs one item at a time (MOTION_PROCESS_WORKERS parallelizes it)
+            results = await asyncio.gather(*(dispatch_motion_item(item) for item in batch), return_exceptions=True)
+            
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"❌ Motion queue processing error: {result}")
             
         except Exception as e:
             logger.error(f"❌ Motion queue processing error: {e}")
@@ -1030,79 +1963,64 @@ async def process_motion_session_start(item: Dict):
         
         logger.info(f"🚀 Processing motion session start: {session_id}")
         
-        # Process image
-        image_pil = Image.open(io.BytesIO(item['image_data']))
-        if image_pil.mode != 'RGB':
-            image_pil = image_pil.convert('RGB')
-        
-        image_array = np.array(image_pil)
-        
-        # Get enrolled students
-        enrolled_students = await get_enrolled_students_for_class(session_data['class_id'])
+        # Process faces with high accuracy for session start
+        config = motion_pipeline_config(item)
+        detected_faces = await run_motion_face_pipeline(item, config, item['motion_strength'])
         
-        if not enrolled_students:
+        if detected_faces is None:
             logger.warning(f"No enrolled students for motion session start: {session_id}")
             return
         
-        # Process faces with high accuracy for session start
-        config = motion_processor.get_config('0-10')  # Use highest accuracy
-        detected_faces = process_motion_triggered_faces(
-            image_array, 
-            enrolled_students, 
-            config, 
-            item['motion_strength']
-        )
-        
-        # Record attendance for session start
-        new_records = 0
-        for face_info in detected_faces:
-            if not face_info['verified']:
-                continue
+        # Read-existing/insert runs one capture at a time per session, so batched captures cannot double-record a student
+        async with session_write_lock(session_id):
+            # Record attendance for session start
+            # Look up all recognized students' emails in one query
+            student_emails = await get_student_emails([f['student_id'] for f in detected_faces if f['verified']])
             
-            student_id = face_info['student_id']
-            confidence = face_info['confidence']
+            created_at = datetime.now().isoformat()
             
-            # Get student email
-            student_result = supabase.table('users').select('email').eq('school_id', student_id).single().execute()
+            records = []
+            for face_info in detected_faces:
+                if not face_info['verified']:
+                    continue
             
-            if not student_result.data:
-                continue
+                student_id = face_info['student_id']
+                confidence = face_info['confidence']
             
-            student_email = student_result.data['email']
+                student_email = student_emails.get(student_id)
+                if not student_email:
+                    continue
             
-            # Record as 'present' for session start
-            record_data = {
-                'session_id': session_id,
-                'student_email': student_email,
-                'student_id': student_id,
-                'check_in_time': item['capture_time'],
-                'status': 'present',  # Session start = present
-                'face_match_score': confidence,
-                'detection_method': 'motion_session_start',
-                'processing_phase': '0-10',
-                'face_quality': face_info.get('quality_score', 1.0),
-                'motion_strength': item['motion_strength'],
-                'trigger_type': 'manual',
-                'created_at': datetime.now().isoformat()
-            }
+                # Record as 'present' for session start
+                record_data = {
+                    'session_id': session_id,
+                    'student_email': student_email,
+                    'student_id': student_id,
+                    'check_in_time': item['capture_time'],
+                    'status': 'present',  # Session start = present
+                    'face_match_score': confidence,
+                    'detection_method': 'motion_session_start',
+                    'processing_phase': '0-10',
+                    'face_quality': face_info.get('quality_score', 1.0),
+                    'motion_strength': item['motion_strength'],
+                    'trigger_type': 'manual',
+                    'created_at': created_at
+                }
             
-            try:
-                supabase.table('attendance_records').insert(record_data).execute()
-                new_records += 1
-                logger.info(f"✅ Motion session start attendance recorded for {student_id}")
-            except Exception as e:
-                logger.error(f"❌ Error saving motion session start record for {student_id}: {e}")
+                records.append(record_data)
+            
+            new_records = await insert_attendance_records(records, "Motion session start")
         
         processing_time = time.time() - start_time
         
         # Update capture log
-        supabase.table('motion_captures').update({
+        await run_supabase(supabase.table('motion_captures').update({
             'faces_detected': len(detected_faces),
-            'faces_recognized': len([f for f in detected_faces if f['verified']]),
+            'faces_recognized': sum(1 for f in detected_faces if f['verified']),
             'new_records': new_records,
             'processing_time_ms': int(processing_time * 1000),
             'processing_status': 'completed'
-        }).eq('session_id', session_id).eq('capture_time', item['capture_time']).execute()
+        }).eq('session_id', session_id).eq('capture_time', item['capture_time']))
         
         logger.info(f"🎯 Motion session start processing complete: {new_records} students recorded in {processing_time:.2f}s")
         
@@ -1111,10 +2029,10 @@ async def process_motion_session_start(item: Dict):
         
         # Update status to failed
         try:
-            supabase.table('motion_captures').update({
+            await run_supabase(supabase.table('motion_captures').update({
                 'processing_status': 'failed',
                 'error_message': str(e)
-            }).eq('session_id', item['session_id']).eq('capture_time', item['capture_time']).execute()
+            }).eq('session_id', item['session_id']).eq('capture_time', item['capture_time']))
         except:
             pass
 
@@ -1130,92 +2048,75 @@ async def process_motion_triggered_background(item: Dict):
         
         logger.info(f"🚶 Processing motion-triggered capture: {session_id} (phase: {phase}, strength: {motion_strength:.3f})")
         
-        # Process image
-        image_pil = Image.open(io.BytesIO(item['image_data']))
-        if image_pil.mode != 'RGB':
-            image_pil = image_pil.convert('RGB')
-        
-        image_array = np.array(image_pil)
-        
-        # Get enrolled students (cached)
-        enrolled_students = await get_enrolled_students_for_class(session_data['class_id'])
+        # Process faces with motion-specific optimizations
+        detected_faces = await run_motion_face_pipeline(item, config, motion_strength)
         
-        if not enrolled_students:
+        if detected_faces is None:
             logger.warning(f"No enrolled students for motion capture: {session_id}")
             return
         
-        # Process faces with motion-specific optimizations
-        detected_faces = process_motion_triggered_faces(
-            image_array, 
-            enrolled_students, 
-            config, 
-            motion_strength
-        )
-        
-        # Record new attendance
-        new_records = 0
-        for face_info in detected_faces:
-            if not face_info['verified']:
-                continue
+        # Read-existing/insert runs one capture at a time per session, so batched captures cannot double-record a student
+        async with session_write_lock(session_id):
+            # Record new attendance
+            # Look up emails and existing records for all recognized students in two queries
+            student_emails = await get_student_emails([f['student_id'] for f in detected_faces if f['verified']])
+            recorded_emails = await get_recorded_emails(session_id, list(student_emails.values()))
             
-            student_id = face_info['student_id']
-            confidence = face_info['confidence']
+            # Timing is the same for every face in the capture, so work it out once
+            capture_status = determine_capture_status(item['capture_time'], session_data) if student_emails else None
+            created_at = datetime.now().isoformat()
             
-            # Get student email
-            student_result = supabase.table('users').select('email').eq('school_id', student_id).single().execute()
-            
-            if not student_result.data:
-                continue
+            records = []
+            for face_info in detected_faces:
+                if not face_info['verified']:
+                    continue
             
-            student_email = student_result.data['email']
+                student_id = face_info['student_id']
+                confidence = face_info['confidence']
             
-            # Check if already recorded
-            existing_record = supabase.table('attendance_records').select('id').eq('session_id', session_id).eq('student_email', student_email).execute()
+                student_email = student_emails.get(student_id)
+                if not student_email:
+                    continue
             
-            if existing_record.data:
-                continue  # Skip if already recorded
+                # Check if already recorded
+                if student_email in recorded_emails:
+                    continue  # Skip if already recorded
+                recorded_emails.add(student_email)
             
-            # Determine status based on timing
-            capture_dt = datetime.fromisoformat(item['capture_time'].replace('Z', '+00:00'))
-            session_start = datetime.fromisoformat(session_data['start_time'].replace('Z', '+00:00'))
-            on_time_limit = session_start + timedelta(minutes=session_data['on_time_limit_minutes'])
+                # Determine status based on timing
+                status = capture_status
             
-            status = 'present' if capture_dt <= on_time_limit else 'late'
+                # Record motion-triggered attendance
+                record_data = {
+                    'session_id': session_id,
+                    'student_email': student_email,
+                    'student_id': student_id,
+                    'check_in_time': item['capture_time'],
+                    'status': status,
+                    'face_match_score': confidence,
+                    'detection_method': 'motion_triggered',
+                    'processing_phase': phase,
+                    'face_quality': face_info.get('quality_score', 1.0),
+                    'motion_strength': motion_strength,
+                    'trigger_type': 'motion',
+                    'device_id': item.get('device_id'),
+                    'created_at': created_at
+                }
             
-            # Record motion-triggered attendance
-            record_data = {
-                'session_id': session_id,
-                'student_email': student_email,
-                'student_id': student_id,
-                'check_in_time': item['capture_time'],
-                'status': status,
-                'face_match_score': confidence,
-                'detection_method': 'motion_triggered',
-                'processing_phase': phase,
-                'face_quality': face_info.get('quality_score', 1.0),
-                'motion_strength': motion_strength,
-                'trigger_type': 'motion',
-                'device_id': item.get('device_id'),
-                'created_at': datetime.now().isoformat()
-            }
+                records.append(record_data)
             
-            try:
-                supabase.table('attendance_records').insert(record_data).execute()
-                new_records += 1
-                logger.info(f"✅ Motion-triggered attendance recorded for {student_id}: {status}")
-            except Exception as e:
-                logger.error(f"❌ Error saving motion record for {student_id}: {e}")
+            new_records = await insert_attendance_records(records, "Motion-triggered")
         
         processing_time = time.time() - start_time
         
         # Update capture log
-        supabase.table('motion_captures').update({
+        await run_supabase(supabase.table('motion_captures').update({
             'faces_detected': len(detected_faces),
-            'faces_recognized': len([f for f in detected_faces if f['verified']]),
+            'faces_recognized': sum(1 for f in detected_faces if f['verified']),
             'new_records': new_records,
             'processing_time_ms': int(processing_time * 1000),
             'processing_status': 'completed'
-        }).eq('session_id', session_id).eq('capture_time', item['capture_time']).execute()
+        }).eq('session_id', session_id).eq('capture_time', item['capture_time']))
         
         logger.info(f"🤖 Motion capture complete: {new_records} new records in {processing_time:.2f}s")
         
@@ -1224,10 +2125,10 @@ async def process_motion_triggered_background(item: Dict):
         
         # Update status to failed
         try:
-            supabase.table('motion_captures').update({
+            await run_supabase(supabase.table('motion_captures').update({
                 'processing_status': 'failed',
                 'error_message': str(e)
-            }).eq('session_id', item['session_id']).eq('capture_time', item['capture_time']).execute()
+            }).eq('session_id', item['session_id']).eq('capture_time', item['capture_time']))
         except:
             pass
 
@@ -1237,102 +2138,80 @@ async def process_manual_teacher_motion_capture(item: Dict):
         start_time = time.time()
         session_id = item['session_id']
         session_data = item['session_data']
-        config = item['config']
         phase = item['phase']
         
         logger.info(f"👨‍🏫 Processing manual teacher capture in motion session: {session_id} (phase: {phase})")
         
-        # Process image with high priority settings
-        image_pil = Image.open(io.BytesIO(item['image_data']))
-        if image_pil.mode != 'RGB':
-            image_pil = image_pil.convert('RGB')
-        
-        image_array = np.array(image_pil)
-        
-        # Get enrolled students
-        enrolled_students = await get_enrolled_students_for_class(session_data['class_id'])
+        detected_faces = await run_motion_face_pipeline(item, motion_pipeline_config(item), item['motion_strength'])
         
-        if not enrolled_students:
+        if detected_faces is None:
             logger.warning(f"No enrolled students for manual motion capture: {session_id}")
             return
         
-        # Use high accuracy for manual teacher captures
-        manual_config = config.copy()
-        manual_config['model_accuracy'] = 'high'
-        manual_config['enable_quality_check'] = True
-        
-        detected_faces = process_motion_triggered_faces(
-            image_array, 
-            enrolled_students, 
-            manual_config, 
-            item['motion_strength']
-        )
-        
-        # Record new attendance
-        new_records = 0
-        for face_info in detected_faces:
-            if not face_info['verified']:
-                continue
+        # Read-existing/insert runs one capture at a time per session, so batched captures cannot double-record a student
+        async with session_write_lock(session_id):
+            # Record new attendance
+            # Look up emails and existing records for all recognized students in two queries
+            student_emails = await get_student_emails([f['student_id'] for f in detected_faces if f['verified']])
+            force_capture = item.get('force_capture', False)
+            recorded_emails = set() if force_capture else await get_recorded_emails(session_id, list(student_emails.values()))
             
-            student_id = face_info['student_id']
-            confidence = face_info['confidence']
+            # Timing is the same for every face in the capture, so work it out once
+            capture_status = determine_capture_status(item['capture_time'], session_data) if student_emails else None
+            created_at = datetime.now().isoformat()
             
-            # Get student email
-            student_result = supabase.table('users').select('email').eq('school_id', student_id).single().execute()
+            records = []
+            for face_info in detected_faces:
+                if not face_info['verified']:
+                    continue
             
-            if not student_result.data:
-                continue
+                student_id = face_info['student_id']
+                confidence = face_info['confidence']
             
-            student_email = student_result.data['email']
+                student_email = student_emails.get(student_id)
+                if not student_email:
+                    continue
             
-            # Check if already recorded (skip for forced captures)
-            if not item.get('force_capture', False):
-                existing_record = supabase.table('attendance_records').select('id').eq('session_id', session_id).eq('student_email', student_email).execute()
-                
-                if existing_record.data:
-                    continue  # Skip if already recorded
+                # Check if already recorded (skip for forced captures)
+                if not force_capture:
+                    if student_email in recorded_emails:
+                        continue  # Skip if already recorded
+                    recorded_emails.add(student_email)
             
-            # Determine status based on timing
-            capture_dt = datetime.fromisoformat(item['capture_time'].replace('Z', '+00:00'))
-            session_start = datetime.fromisoformat(session_data['start_time'].replace('Z', '+00:00'))
-            on_time_limit = session_start + timedelta(minutes=session_data['on_time_limit_minutes'])
+                # Determine status based on timing
+                status = capture_status
             
-            status = 'present' if capture_dt <= on_time_limit else 'late'
+                # Record manual teacher attendance
+                record_data = {
+                    'session_id': session_id,
+                    'student_email': student_email,
+                    'student_id': student_id,
+                    'check_in_time': item['capture_time'],
+                    'status': status,
+                    'face_match_score': confidence,
+                    'detection_method': 'manual_teacher_motion',
+                    'processing_phase': phase,
+                    'face_quality': face_info.get('quality_score', 1.0),
+                    'motion_strength': item['motion_strength'],
+                    'trigger_type': 'manual',
+                    'force_capture': force_capture,
+                    'created_at': created_at
+                }
             
-            # Record manual teacher attendance
-            record_data = {
-                'session_id': session_id,
-                'student_email': student_email,
-                'student_id': student_id,
-                'check_in_time': item['capture_time'],
-                'status': status,
-                'face_match_score': confidence,
-                'detection_method': 'manual_teacher_motion',
-                'processing_phase': phase,
-                'face_quality': face_info.get('quality_score', 1.0),
-                'motion_strength': item['motion_strength'],
-                'trigger_type': 'manual',
-                'force_capture': item.get('force_capture', False),
-                'created_at': datetime.now().isoformat()
-            }
+                records.append(record_data)
             
-            try:
-                supabase.table('attendance_records').insert(record_data).execute()
-                new_records += 1
-                logger.info(f"✅ Manual teacher motion attendance recorded for {student_id}: {status}")
-            except Exception as e:
-                logger.error(f"❌ Error saving manual teacher motion record for {student_id}: {e}")
+            new_records = await insert_attendance_records(records, "Manual teacher motion")
         
         processing_time = time.time() - start_time
         
         # Update capture log
-        supabase.table('motion_captures').update({
+        await run_supabase(supabase.table('motion_captures').update({
             'faces_detected': len(detected_faces),
-            'faces_recognized': len([f for f in detected_faces if f['verified']]),
+            'faces_recognized': sum(1 for f in detected_faces if f['verified']),
             'new_records': new_records,
             'processing_time_ms': int(processing_time * 1000),
             'processing_status': 'completed'
-        }).eq('session_id', session_id).eq('capture_time', item['capture_time']).execute()
+        }).eq('session_id', session_id).eq('capture_time', item['capture_time']))
         
         logger.info(f"👨‍🏫 Manual teacher motion capture complete: {new_records} new records in {processing_time:.2f}s")
         
@@ -1341,10 +2220,10 @@ async def process_manual_teacher_motion_capture(item: Dict):
         
         # Update status to failed
         try:
-            supabase.table('motion_captures').update({
+            await run_supabase(supabase.table('motion_captures').update({
                 'processing_status': 'failed',
                 'error_message': str(e)
-            }).eq('session_id', item['session_id']).eq('capture_time', item['capture_time']).execute()
+            }).eq('session_id', item['session_id']).eq('capture_time', item['capture_time']))
         except:
             pass
 
@@ -1355,17 +2234,23 @@ async def end_motion_detection_session(session_id: str):
     """End motion detection attendance session"""
     try:
         # Validate and end session
-        result = supabase.table('attendance_sessions').update({
+        result = await run_supabase(supabase.table('attendance_sessions').update({
             'status': 'ended',
             'ended_at': datetime.now().isoformat(),
             'updated_at': datetime.now().isoformat()
-        }).eq('id', session_id).eq('session_type', 'motion_detection').execute()
+        }).eq('id', session_id).eq('session_type', 'motion_detection'))
         
         if not result.data:
             raise HTTPException(status_code=404, detail="Motion detection session not found")
         
         # Remove from motion session manager
         motion_session_manager.remove_session(session_id)
+        with session_frame_lock:
+            session_frame_cache.pop(session_id, None)
+        with detection_cache_lock:
+            for key in [key for key in face_crop_cache if key[0] == session_id]:
+                del face_crop_cache[key]
+        session_write_locks.pop(session_id, None)
         
         logger.info(f"📝 Motion detection session ended: {session_id}")
         
@@ -1405,20 +2290,19 @@ async def get_motion_session_statistics(session_id: str):
 async def get_motion_session_statistics_internal(session_id: str) -> Dict:
     """Internal function to get comprehensive motion session statistics"""
     try:
-        # Get session info
-        session_result = supabase.table('attendance_sessions').select('*').eq('id', session_id).single().execute()
+        # Get session info, attendance records and motion capture logs concurrently
+        # (only the columns the statistics below actually read)
+        session_result, records_result, captures_result = await asyncio.gather(
+            run_supabase(supabase.table('attendance_sessions').select('*').eq('id', session_id).single()),
+            run_supabase(supabase.table('attendance_records').select('status, detection_method').eq('session_id', session_id)),
+            run_supabase(supabase.table('motion_captures').select('capture_type, trigger_type, motion_strength, processing_phase, faces_detected, faces_recognized').eq('session_id', session_id).order('capture_time'))
+        )
         
         if not session_result.data:
             raise ValueError("Motion detection session not found")
         
         session_data = session_result.data
-        
-        # Get attendance records
-        records_result = supabase.table('attendance_records').select('*').eq('session_id', session_id).execute()
         records = records_result.data or []
-        
-        # Get motion capture logs
-        captures_result = supabase.table('motion_captures').select('*').eq('session_id', session_id).order('capture_time').execute()
         captures = captures_result.data or []
         
         # Get motion session stats from manager
@@ -1428,9 +2312,16 @@ async def get_motion_session_statistics_internal(session_id: str) -> Dict:
         enrolled_students = await get_enrolled_students_for_class(session_data['class_id'])
         total_students = len(enrolled_students)
         
+        # Single pass over records for status and detection method counts
+        status_counts = Counter()
+        method_stats = Counter()
+        for record in records:
+            status_counts[record['status']] += 1
+            method_stats[record.get('detection_method', 'unknown')] += 1
+        
         # Calculate attendance statistics
-        present_count = len([r for r in records if r['status'] == 'present'])
-        late_count = len([r for r in records if r['status'] == 'late'])
+        present_count = status_counts['present']
+        late_count = status_counts['late']
         absent_count = total_students - len(records)
         attendance_rate = len(records) / total_students if total_students > 0 else 0
         
@@ -1439,23 +2330,20 @@ async def get_motion_session_statistics_internal(session_id: str) -> Dict:
         snapshots_taken = motion_stats.get('snapshots_taken', 0)
         snapshot_efficiency = snapshots_taken / motion_events if motion_events > 0 else 0
         
-        # Capture type breakdown
-        capture_types = {}
-        trigger_types = {}
-        for capture in captures:
-            capture_type = capture.get('capture_type', 'unknown')
-            trigger_type = capture.get('trigger_type', 'unknown')
-            
-            capture_types[capture_type] = capture_types.get(capture_type, 0) + 1
-            trigger_types[trigger_type] = trigger_types.get(trigger_type, 0) + 1
-        
-        # Motion strength analysis
-        motion_strengths = [c.get('motion_strength', 0) for c in captures if c.get('motion_strength')]
-        avg_motion_strength = np.mean(motion_strengths) if motion_strengths else 0
-        
-        # Processing phase breakdown
+        # Single pass over captures for type, trigger, motion strength and phase breakdowns
+        capture_types = Counter()
+        trigger_types = Counter()
+        motion_strength_total = 0.0
+        motion_strength_count = 0
         phase_stats = {}
         for capture in captures:
+            capture_types[capture.get('capture_type', 'unknown')] += 1
+            trigger_types[capture.get('trigger_type', 'unknown')] += 1
+            
+            if capture.get('motion_strength'):
+                motion_strength_total += capture['motion_strength']
+                motion_strength_count += 1
+            
             phase = capture.get('processing_phase', 'unknown')
             if phase not in phase_stats:
                 phase_stats[phase] = {'count': 0, 'faces_detected': 0, 'faces_recognized': 0}
@@ -1463,11 +2351,7 @@ async def get_motion_session_statistics_internal(session_id: str) -> Dict:
             phase_stats[phase]['faces_detected'] += capture.get('faces_detected', 0)
             phase_stats[phase]['faces_recognized'] += capture.get('faces_recognized', 0)
         
-        # Detection method breakdown
-        method_stats = {}
-        for record in records:
-            method = record.get('detection_method', 'unknown')
-            method_stats[method] = method_stats.get(method, 0) + 1
+        avg_motion_strength = motion_strength_total / motion_strength_count if motion_strength_count else 0
         
         return {
             "session_info": session_data,
@@ -1487,11 +2371,11 @@ async def get_motion_session_statistics_internal(session_id: str) -> Dict:
                 "cooldown_seconds": session_data.get('cooldown_seconds', MOTION_COOLDOWN_SECONDS)
             },
             "capture_breakdown": {
-                "by_type": capture_types,
-                "by_trigger": trigger_types
+                "by_type": dict(capture_types),
+                "by_trigger": dict(trigger_types)
             },
             "phase_breakdown": phase_stats,
-            "method_breakdown": method_stats,
+            "method_breakdown": dict(method_stats),
             "processing_queue_size": motion_processing_queue.qsize(),
             "hourly_motion_events": motion_stats.get('hourly_events', {})
         }
@@ -1521,18 +2405,23 @@ async def motion_system_health():
             'motion_captures'  # New table for motion system
         ]
         
-        table_status = {}
-        for table in required_tables:
+        async def check_table(table: str) -> str:
             try:
-                result = supabase.table(table).select("count", count='exact').limit(1).execute()
-                table_status[table] = "ok"
+                await run_supabase(supabase.table(table).select("count", count='exact').limit(1))
+                return "ok"
             except Exception as e:
                 logger.error(f"Table {table} check failed: {e}")
-                table_status[table] = f"error: {str(e)}"
+                return f"error: {str(e)}"
+        
+        # Check all tables concurrently so one slow table does not delay the rest
+        statuses = await asyncio.gather(*(check_table(table) for table in required_tables))
+        table_status = dict(zip(required_tables, statuses))
         
         # Cache and queue statistics
         with cache_lock:
             cache_size = len(face_cache)
+            cache_hits = face_cache_stats['hits']
+            cache_misses = face_cache_stats['misses']
         
         queue_size = motion_processing_queue.qsize()
         
@@ -1561,6 +2450,10 @@ async def motion_system_health():
             "database_tables": table_status,
             "performance": {
                 "face_cache_size": cache_size,
+                "face_cache_max_size": FACE_CACHE_MAX_SIZE,
+                "face_cache_hits": cache_hits,
+                "face_cache_misses": cache_misses,
+                "face_cache_hit_rate": cache_hits / (cache_hits + cache_misses) if cache_hits + cache_misses > 0 else 0,
                 "processing_queue_size": queue_size,
                 "active_motion_sessions": active_motion_sessions,
                 "thread_pool_workers": executor._max_workers,
@@ -1575,6 +2468,7 @@ async def motion_system_health():
             },
             "configuration": {
                 "face_threshold": FACE_THRESHOLD,
+                "similarity_metric": SIMILARITY_METRIC,
                 "debug_mode": DEBUG,
                 "version": "5.0.0-motion-detection",
                 "supported_features": [
@@ -1603,7 +2497,7 @@ async def get_motion_system_status():
     """Get comprehensive motion detection system status"""
     try:
         # Active motion sessions
-        active_sessions = supabase.table('attendance_sessions').select('id, class_id, start_time, motion_threshold').eq('status', 'active').eq('session_type', 'motion_detection').execute()
+        active_sessions = await run_supabase(supabase.table('attendance_sessions').select('id, class_id, start_time, motion_threshold').eq('status', 'active').eq('session_type', 'motion_detection'))
         
         # Processing statistics
         with cache_lock:
@@ -1623,7 +2517,7 @@ async def get_motion_system_status():
             }
         
         # Recent motion activity
-        recent_captures = supabase.table('motion_captures').select('*').gte('created_at', (datetime.now() - timedelta(hours=1)).isoformat()).execute()
+        recent_captures = await run_supabase(supabase.table('motion_captures').select('*').gte('created_at', (datetime.now() - timedelta(hours=1)).isoformat()))
         
         # Motion trigger analysis
         motion_triggers = {}
@@ -1678,20 +2572,26 @@ async def get_live_motion_stats(session_id: str):
             raise HTTPException(status_code=404, detail="Motion session not found")
         
         # Get recent captures (last hour)
-        recent_captures = supabase.table('motion_captures').select('*').eq('session_id', session_id).gte('created_at', (datetime.now() - timedelta(hours=1)).isoformat()).execute()
-        
-        # Calculate live metrics
-        total_captures = len(recent_captures.data or [])
-        successful_captures = len([c for c in recent_captures.data or [] if c.get('processing_status') == 'completed'])
+        recent_captures = await run_supabase(supabase.table('motion_captures').select('processing_status, motion_strength').eq('session_id', session_id).gte('created_at', (datetime.now() - timedelta(hours=1)).isoformat()))
         
-        # Motion strength distribution
-        motion_strengths = [c.get('motion_strength', 0) for c in recent_captures.data or [] if c.get('motion_strength')]
+        # Calculate live metrics and the motion strength distribution in one pass
+        captures = recent_captures.data or []
+        total_captures = len(captures)
+        successful_captures = 0
+        strength_distribution = {'weak': 0, 'moderate': 0, 'strong': 0}
         
-        strength_distribution = {
-            'weak': len([s for s in motion_strengths if s < 0.2]),
-            'moderate': len([s for s in motion_strengths if 0.2 <= s < 0.5]),
-            'strong': len([s for s in motion_strengths if s >= 0.5])
-        }
+        for capture in captures:
+            if capture.get('processing_status') == 'completed':
+                successful_captures += 1
+            strength = capture.get('motion_strength')
+            if not strength:
+                continue
+            if strength < 0.2:
+                strength_distribution['weak'] += 1
+            elif strength < 0.5:
+                strength_distribution['moderate'] += 1
+            else:
+                strength_distribution['strong'] += 1
         
         # Processing queue status for this session
         queue_items_for_session = 0  # Would need to implement queue inspection
@@ -1733,9 +2633,17 @@ async def clear_motion_cache():
         with cache_lock:
             cache_size = len(face_cache)
             face_cache.clear()
+            roster_matrix_cache.clear()
+            class_roster_cache.clear()
+            student_email_cache.clear()
+        with detection_cache_lock:
+            face_crop_cache.clear()
+        
+        if FACE_CACHE_PATH:
+            await asyncio.to_thread(persist_face_cache)
         
         # Reset motion session manager for inactive sessions
-        active_sessions = supabase.table('attendance_sessions').select('id').eq('status', 'active').eq('session_type', 'motion_detection').execute()
+        active_sessions = await run_supabase(supabase.table('attendance_sessions').select('id').eq('status', 'active').eq('session_type', 'motion_detection'))
         active_session_ids = [s['id'] for s in active_sessions.data or []]
         
         removed_sessions = 0
@@ -1780,48 +2688,18 @@ async def enroll_face_for_motion_system(
         all_encodings = []
         quality_scores = []
         
-        # Process each image with high accuracy for enrollment
-        for idx, image_file in enumerate(images):
-            try:
-                image_data = await image_file.read()
-                image = Image.open(io.BytesIO(image_data))
-                
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                image_array = np.array(image)
-                
-                # Use CNN model for enrollment (highest accuracy)
-                face_locations = face_recognition.face_locations(image_array, model="cnn")
-                
-                if len(face_locations) == 0:
-                    logger.warning(f"No face detected in enrollment image {idx + 1}")
-                    continue
-                
-                if len(face_locations) > 1:
-                    logger.warning(f"Multiple faces detected in enrollment image {idx + 1}, using the largest one")
-                    # Sort by face size and use the largest
-                    face_locations = sorted(face_locations, key=lambda loc: (loc[2]-loc[0])*(loc[1]-loc[3]), reverse=True)
-                
-                # Get high-quality face encoding
-                face_encodings = face_recognition.face_encodings(
-                    image_array, 
-                    face_locations[:1], 
-                    num_jitters=3  # Higher jitters for better enrollment
-                )
-                
-                if face_encodings:
-                    all_encodings.append(face_encodings[0])
-                    
-                    # Calculate quality for this enrollment image
-                    quality = calculate_face_quality(image_array, face_locations[0])
-                    quality_scores.append(quality['overall_score'])
-                    
-                    logger.info(f"✅ Processed enrollment image {idx + 1} (quality: {quality['overall_score']:.3f})")
-                
-            except Exception as e:
-                logger.error(f"Error processing enrollment image {idx + 1}: {e}")
-                continue
+        # Process the images concurrently with high accuracy for enrollment
+        loop = asyncio.get_running_loop()
+        image_datas = await asyncio.gather(*(image_file.read() for image_file in images))
+        results = await asyncio.gather(*(
+            loop.run_in_executor(process_executor or executor, process_enrollment_image, image_data, idx)
+            for idx, image_data in enumerate(image_datas)
+        ))
+        
+        for result in results:
+            if result is not None:
+                all_encodings.append(result[0])
+                quality_scores.append(result[1])
         
         if not all_encodings:
             raise HTTPException(status_code=400, detail="No valid face encodings for motion detection system")
@@ -1855,6 +2733,14 @@ async def enroll_face_for_motion_system(
         with cache_lock:
             if student_id in face_cache:
                 del face_cache[student_id]
+            roster_matrix_cache.clear()
+        
+        # Keep the snapshot from restoring the old embedding after a restart
+        if FACE_CACHE_PATH:
+            try:
+                await asyncio.to_thread(persist_face_cache)
+            except Exception as e:
+                logger.error(f"❌ Failed to persist face cache after enrollment: {e}")
         
         logger.info(f"✅ Face enrolled for motion detection: {student_id}")
         
@@ -1901,12 +2787,13 @@ async def save_face_embedding_to_db(
             logger.error("Invalid encoding format for motion detection system")
             return False
         
-        embedding_json = encoding.tolist()
+        # orjson serializes the numpy array directly, skipping the tolist() + stdlib json round-trip
+        embedding_json = orjson.dumps(np.ascontiguousarray(encoding), option=orjson.OPT_SERIALIZE_NUMPY).decode()
         quality = max(0.0, min(1.0, float(quality)))
         
         face_data = {
             'student_id': student_id,
-            'face_embedding_json': json.dumps(embedding_json),
+            'face_embedding_json': embedding_json,
             'face_quality': quality,
             'enrollment_type': enrollment_type,
             'images_used': images_used,
@@ -1917,21 +2804,24 @@ async def save_face_embedding_to_db(
             'updated_at': datetime.now().isoformat()
         }
         
+        if FACE_EMBEDDING_BYTES_ENABLED:
+            face_data['face_embedding_bytes'] = encode_embedding_bytes(encoding)
+        
         # Verify student exists
-        student_check = supabase.table('users').select('school_id').eq('school_id', student_id).execute()
+        student_check = await run_supabase(supabase.table('users').select('school_id').eq('school_id', student_id))
         
         if not student_check.data:
             logger.error(f"Student {student_id} not found for motion detection enrollment")
             return False
         
         # Deactivate old embeddings
-        supabase.table('student_face_embeddings').update({
+        await run_supabase(supabase.table('student_face_embeddings').update({
             'is_active': False,
             'updated_at': datetime.now().isoformat()
-        }).eq('student_id', student_id).execute()
+        }).eq('student_id', student_id))
         
         # Insert new embedding
-        result = supabase.table('student_face_embeddings').insert(face_data).execute()
+        result = await run_supabase(supabase.table('student_face_embeddings').insert(face_data))
         
         if result.data:
             logger.info(f"✅ Face data saved for motion detection: {student_id} (quality: {quality:.2f}, images: {images_used})")
@@ -1977,10 +2867,19 @@ if __name__ == "__main__":
     print("   - Simple Check-in")
     print("=" * 60)
     
+    # uvloop/httptools ship with uvicorn[standard] (uvloop is not available on Windows)
+    try:
+        import uvloop  # noqa: F401
+        loop_impl = "uvloop"
+    except ImportError:
+        loop_impl = "asyncio"
+    
     uvicorn.run(
         app, 
         host=HOST, 
         port=PORT, 
         log_level="info",
-        reload=DEBUG
+        reload=DEBUG,
+        loop=loop_impl,
+        http="httptools"
     )
\ No newline at end of file